@@ -1,5 +1,25 @@
 
-from clarify_cody.client import Client  # noqa
-
 from clarify_cody.constants import __author__  # noqa
 from clarify_cody.constants import __version__  # noqa
+
+# The clients are imported when first used, so that importing the package,
+# or only its helpers and errors, doesn't load the HTTP stack.
+_LAZY_ATTRIBUTES = {
+    'Client': 'clarify_cody.client',
+    'ShardedClient': 'clarify_cody.sharded',
+    'AsyncClient': 'clarify_cody.aio',
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError("module 'clarify_cody' has no attribute '{}'".format(name))
+    import importlib
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
@@ -0,0 +1,106 @@
+"""
+.. module:: clarify_cody.aio
+   : synopsis: 'asyncio front end for the Clarify Conversation Dynamics API client'
+"""
+
+import asyncio
+import contextvars
+import copy
+import functools
+
+from clarify_cody.client import Client, _request_key
+from clarify_cody.scheduler import get_priority
+
+
+class AsyncClient(object):
+    """Exposes the Client methods as coroutines.
+
+    Requests are executed by a wrapped Client in an executor (the default
+    executor of the loop unless one is given). Concurrent identical
+    conversation fetches are coalesced on the event loop before reaching
+    the executor, and again inside the Client, so coroutines and threads
+    fetching the same conversation share a single HTTP request.
+    """
+
+    def __init__(self, key, url=None, executor=None, client=None):
+        """
+        'key' and 'url' are passed to Client.
+        'executor' a concurrent.futures.Executor used to run the requests.
+        'client' an existing Client to wrap instead of creating one.
+        """
+        self.client = client if client is not None else Client(key, url)
+        self.executor = executor
+        self._in_flight = {}
+        self._coalesced = 0
+
+    async def _run(self, func, *args, **kwargs):
+        # Run in the task's context, to keep its priority() scope.
+        loop = asyncio.get_event_loop()
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    async def _run_coalesced(self, key, func, *args, **kwargs):
+        # Followers get their own copy of the result, like callers
+        # coalesced by the wrapped Client. Only calls of the same priority
+        # class are coalesced.
+        key = (get_priority() or self.client.scheduler.default_class, key)
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._coalesced += 1
+            return copy.deepcopy(await asyncio.shield(future))
+
+        future = asyncio.ensure_future(self._run(func, *args, **kwargs))
+        self._in_flight[key] = future
+        future.add_done_callback(lambda f: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def get_conversation_list(self, href=None, limit=None):
+        """See Client.get_conversation_list()."""
+        return await self._run(self.client.get_conversation_list, href, limit)
+
+    async def create_conversation(self, external_id=None, participants=None, options=None, notify_url=None):
+        """See Client.create_conversation()."""
+        return await self._run(self.client.create_conversation, external_id, participants,
+                               options, notify_url)
+
+    async def get_conversation(self, href=None, embed=None, refresh=False):
+        """See Client.get_conversation(). Concurrent identical calls are
+        coalesced."""
+        assert href is not None
+        key = (refresh, _request_key(href, _embed_fields(embed)))
+        return await self._run_coalesced(key, self.client.get_conversation, href, embed, refresh)
+
+    async def get_conversation_for_external_id(self, external_id, embed=None):
+        """See Client.get_conversation_for_external_id(). Concurrent
+        identical calls are coalesced."""
+        assert external_id is not None
+        key = (external_id, _request_key(None, _embed_fields(embed)))
+        return await self._run_coalesced(key, self.client.get_conversation_for_external_id,
+                                         external_id, embed)
+
+    async def resolve_external_ids(self, external_ids, concurrency=None):
+        """See Client.resolve_external_ids()."""
+        return await self._run(self.client.resolve_external_ids, list(external_ids), concurrency)
+
+    async def delete_conversation(self, href=None):
+        """See Client.delete_conversation()."""
+        return await self._run(self.client.delete_conversation, href)
+
+    def get_last_status(self):
+        """Returns the HTTP status code of the most recent request made
+        by the wrapped client."""
+        return self.client.get_last_status()
+
+    def get_coalesced_count(self):
+        """Returns the number of requests that were not sent because an
+        identical request was already in flight, on the event loop or in
+        the wrapped client."""
+        return self._coalesced + self.client.get_coalesced_count()
+
+
+def _embed_fields(embed):
+    if embed is None:
+        return None
+    if isinstance(embed, str):
+        return {'embed': embed}
+    return {'embed': '+'.join(embed)}
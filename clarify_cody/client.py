@@ -5,15 +5,21 @@
 
 import sys
 import collections
+import contextvars
 import json
-import urllib3
-import certifi
+import threading
+import time
 try:
     from urllib.parse import urlparse, parse_qs
 except ImportError:
     from urlparse import urlparse, parse_qs
 
+from .compression import DecodeError, TransferStats, accept_encoding, compress_body, get_decoder
 from .errors import APIRequestException, APIDataException
+from .index import ExternalIdIndex
+from .resource import Resource
+from .scheduler import RequestScheduler, BATCH, get_priority, priority as priority_scope
+from .singleflight import SingleFlight
 
 from clarify_cody.constants import __version__
 from clarify_cody.constants import __api_version__
@@ -22,6 +28,8 @@ from clarify_cody.constants import __host__
 
 
 CONVERSATIONS_PATH = 'conversations'
+READ_CHUNK_SIZE = 65536
+MIN_SCHEDULER_SLOTS = 10
 PYTHON_VERSION = '.'.join(str(i) for i in sys.version_info[:3])
 
 #
@@ -32,9 +40,29 @@ PYTHON_VERSION = '.'.join(str(i) for i in sys.version_info[:3])
 class Client(object):
     """Holds the environment."""
 
-    def __init__(self, key, url=None):
+    def __init__(self, key, url=None, maxsize=1, external_id_index=None, conversation_cache=None,
+                 rate_limiter=None, scheduler=None, compress_requests=False, compress_min_size=1024):
         """
         url can be https://host:port or hostname or host:port
+        maxsize is the number of connections kept open to the host. Raise
+        it when the client is used from several threads.
+        external_id_index is an ExternalIdIndex to fill and answer
+        external_id lookups from. If None, the client gets its own.
+        conversation_cache is an optional ConversationCache. When given,
+        get_conversation() answers from it and only fetches the embeds
+        that are not cached yet.
+        rate_limiter is an optional TokenBucket every request takes a token
+        from.
+        scheduler is the RequestScheduler sharing the connections between
+        priority classes. If None, the client gets one with a slot per
+        connection, and at least MIN_SCHEDULER_SLOTS slots so that a
+        client used from several threads doesn't send its requests one at
+        a time: like the connection pool, which opens extra connections
+        when all are busy. Pass RequestScheduler(slots=maxsize) to
+        queue every request beyond the pooled connections by priority.
+        compress_requests enables gzip compression of the request bodies
+        of at least compress_min_size bytes. The server must accept
+        'Content-Encoding: gzip' requests.
         """
         self.key = key
 
@@ -57,14 +85,26 @@ class Client(object):
             port = int(host[i + 1:])
             host = host[:i]
 
-        if tls:
-            self.conn = urllib3.HTTPSConnectionPool(host, port=port, maxsize=1,
-                                                    cert_reqs='CERT_REQUIRED',
-                                                    ca_certs=certifi.where())
-        else:
-            self.conn = urllib3.HTTPConnectionPool(host, port=port, maxsize=1)
+        self.conn = _new_connection_pool(host, port, tls, maxsize)
 
         self._last_status = None
+        self._last_timings = None
+        self.maxsize = maxsize
+        self._single_flight = SingleFlight()
+        self._resources = {}
+        self._resources_lock = threading.Lock()
+        if external_id_index is None:
+            external_id_index = ExternalIdIndex()
+        self.external_id_index = external_id_index
+        self.conversation_cache = conversation_cache
+        self.rate_limiter = rate_limiter
+        if scheduler is None:
+            scheduler = RequestScheduler(slots=max(maxsize, MIN_SCHEDULER_SLOTS))
+        self.scheduler = scheduler
+        self.compress_requests = compress_requests
+        self.compress_min_size = compress_min_size
+        self.transfer_stats = TransferStats()
+        self._accept_encoding = accept_encoding()
         self.user_agent = (__api_lib_name__ + '/' + __version__ + '/' + PYTHON_VERSION)
 
     def get_conversation_list(self, href=None, limit=None):
@@ -93,7 +133,9 @@ class Client(object):
         else:
             j = self._get_conversation_list_next(href, limit)
 
-        return self._parse_json(j)
+        result = self._parse_json(j)
+        self.external_id_index.add_result(result)
+        return result
 
     def _get_conversation_list_first(self, limit=None):
         """Get a list of conversations.
@@ -169,9 +211,18 @@ class Client(object):
 
         If func returns False, the iteration is stopped.
 
+        Unless called inside a priority() scope, the requests made by the
+        iteration, including those made by func, have the 'batch'
+        priority.
+
         Returns the number of conversations iterated.
         Raises urllib3.exceptions.HTTPError
         """
+
+        if get_priority() is None:
+            with priority_scope(BATCH):
+                return self.conversation_list_map(func, conversation_collection)
+
         has_next = True
         next_href = None  # if None, retrieves first page
         stopped = False
@@ -181,6 +232,8 @@ class Client(object):
             # Get a page and perform the requested function.
             if conversation_collection is None:
                 conversation_collection = self.get_conversation_list(next_href)
+            else:
+                self.external_id_index.add_result(conversation_collection)
 
             for i in conversation_collection['_links']['items']:
                 href = i['href']
@@ -240,12 +293,20 @@ class Client(object):
         if raw_result.status < 200 or raw_result.status > 202:
             raise APIRequestException(raw_result.status, raw_result.json)
 
-        return self._parse_json(raw_result.json)
+        result = self._parse_json(raw_result.json)
+        self.external_id_index.add_result(result)
+        return result
 
-    def get_conversation(self, href=None, embed=None):
+    def get_conversation(self, href=None, embed=None, refresh=False):
         """Get a conversation.
         'href' the relative href to the conversation. May not be None.
         'embed' a list of entities to embed in the result.
+        'refresh' if True, the conversation is fetched even if cached.
+
+        If the client has a conversation_cache, the conversation is
+        fetched only the first time (or once expired, see
+        ConversationCache), and later calls only fetch the embeds that
+        haven't been fetched yet, see _upgrade_conversation().
 
         Returns a data structure equivalent to the JSON returned by the API.
         If the response status is not 2xx, throws an APIRequestException.
@@ -257,6 +318,23 @@ class Client(object):
         # Argument error checking.
         assert href is not None
 
+        if self.conversation_cache is not None:
+            embeds = _embed_set(embed)
+            held = None if refresh else self.conversation_cache.held_embeds(href)
+            if held is None:
+                self.conversation_cache.put(href, self._fetch_conversation(href, embed), embeds)
+            elif not embeds <= held:
+                self._upgrade_conversation(href, embeds - held)
+            result = self.conversation_cache.view(href, embeds)
+            if result is not None:
+                return result
+            # Discarded by another thread meanwhile.
+
+        return self._fetch_conversation(href, embed)
+
+    def _fetch_conversation(self, href, embed=None):
+        """Fetch a conversation from the API, see get_conversation()."""
+
         data = None
         fields = {}
 
@@ -269,12 +347,44 @@ class Client(object):
         if len(fields) > 0:
             data = fields
 
-        raw_result = self.get(href, data)
+        result = self._parse_json(self._get_coalesced(href, data))
+        self.external_id_index.add_result(result)
+        return result
 
-        if raw_result.status < 200 or raw_result.status > 202:
-            raise APIRequestException(raw_result.status, raw_result.json)
+    def _upgrade_conversation(self, href, missing):
+        """Fetch the 'missing' embeds of the cached conversation at href
+        and merge them into the cache.
+        Relations the conversation links to are fetched through their
+        link. The others are fetched together by requesting the
+        conversation with only those embeds.
 
-        return self._parse_json(raw_result.json)
+        If the response status is not 2xx, throws an APIRequestException.
+        Raises urllib3.exceptions.HTTPError
+        """
+
+        links = self.conversation_cache.get_links(href)
+        embedded = {}
+        unlinked = []
+
+        for link_relation in sorted(missing):
+            link = links.get(link_relation)
+            if link is None or 'href' not in link:
+                unlinked.append(link_relation)
+                continue
+            try:
+                embedded[link_relation] = self._parse_json(self._get_coalesced(link['href']))
+            except APIRequestException as exception:
+                if exception.get_http_response() != 404:
+                    raise
+                embedded[link_relation] = None
+
+        if len(unlinked) > 0:
+            result = self._fetch_conversation(href, unlinked)
+            result_embedded = result.get('_embedded') or {}
+            for link_relation in unlinked:
+                embedded[link_relation] = result_embedded.get(link_relation)
+
+        self.conversation_cache.merge(href, embedded)
 
     def get_conversation_for_external_id(self, external_id, embed=None):
         """Get a conversation.
@@ -307,12 +417,77 @@ class Client(object):
         if len(fields) > 0:
             data = fields
 
-        raw_result = self.get(path, data)
+        result = self._parse_json(self._get_coalesced(path, data))
+        self.external_id_index.add_result(result, external_id)
+        return result
 
-        if raw_result.status < 200 or raw_result.status > 202:
-            raise APIRequestException(raw_result.status, raw_result.json)
+    def resolve_external_ids(self, external_ids, concurrency=None):
+        """Resolve external_ids to conversation hrefs.
+        'external_ids' an iterable of external_ids.
+        'concurrency' the number of lookups sent in parallel. Every lookup
+        needs one of the client's maxsize connections, so it may not
+        exceed the client's maxsize, and defaults to it.
+
+        The ids found in the client's external_id_index are answered
+        without a network call. The others are looked up concurrently with
+        get_conversation_for_external_id(), which also adds them to the
+        index.
+
+        Returns a dict of external_id -> href. The href is None for the
+        ids that don't match a conversation.
+        If a lookup fails with a status other than 404, throws its
+        APIRequestException.
+        Raises urllib3.exceptions.HTTPError
+        """
 
-        return self._parse_json(raw_result.json)
+        concurrency = self._get_concurrency(concurrency)
+
+        result = {}
+        misses = []
+        for external_id in external_ids:
+            if external_id in result:
+                continue
+            href = self.external_id_index.get(external_id)
+            result[external_id] = href
+            if href is None:
+                misses.append(external_id)
+
+        if len(misses) == 0:
+            return result
+
+        def lookup(external_id):
+            try:
+                self.get_conversation_for_external_id(external_id)
+            except APIRequestException as exception:
+                if exception.get_http_response() != 404:
+                    raise
+            return external_id, self.external_id_index.get(external_id)
+
+        workers = min(concurrency, len(misses))
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Run the lookups in the caller's context, to keep its priority.
+            futures = [executor.submit(contextvars.copy_context().run, lookup, i) for i in misses]
+            for future in futures:
+                external_id, href = future.result()
+                result[external_id] = href
+
+        return result
+
+    def _get_concurrency(self, concurrency=None):
+        """Returns the number of parallel requests to use for a
+        'concurrency' argument: the client's maxsize if None.
+        Asserts that it doesn't exceed the client's maxsize, as every
+        request needs a pooled connection."""
+
+        if concurrency is None:
+            concurrency = self.maxsize
+
+        # Argument error checking.
+        assert 0 < concurrency <= self.maxsize, \
+            'concurrency {} exceeds the maxsize {} of the client'.format(concurrency, self.maxsize)
+
+        return concurrency
 
     def delete_conversation(self, href=None):
         """
@@ -332,6 +507,68 @@ class Client(object):
         if raw_result.status != 204:
             raise APIRequestException(raw_result.status, raw_result.json)
 
+        self.external_id_index.remove_href(href)
+        if self.conversation_cache is not None:
+            self.conversation_cache.discard(href)
+        self.forget_resources(href)
+
+    def purge(self, predicate, concurrency=None, dry_run=False, log_path=None, rate=None, retries=3, limit=None):
+        """Delete every conversation for which predicate returns True,
+        deleting up to 'concurrency' conversations at once, the client's
+        maxsize by default. Raise maxsize for concurrent deletes.
+        See clarify_cody.purge.purge() for the arguments.
+
+        Returns a PurgeReport.
+        Raises urllib3.exceptions.HTTPError
+        """
+
+        from .purge import purge
+        return purge(self, predicate, concurrency, dry_run, log_path, rate, retries, limit)
+
+    def get_resource(self, href=None):
+        """Get a lazy Resource for a model.
+        'href' the relative href to the model. May not be None.
+
+        Resources are kept in an identity map: every call with the same
+        href returns the same Resource, and the model is fetched and
+        parsed at most once, when its content is first accessed. Use
+        forget_resources() to fetch models again.
+
+        Returns a Resource.
+        Accessing the content of the Resource may throw an
+        APIRequestException or an APIDataException, or raise
+        urllib3.exceptions.HTTPError
+        """
+
+        # Argument error checking.
+        assert href is not None
+
+        with self._resources_lock:
+            resource = self._resources.get(href)
+            if resource is None:
+                resource = self._resources[href] = Resource(self, href)
+        return resource
+
+    def _add_resource(self, resource):
+        """Add a Resource whose content is already known to the identity
+        map. Returns the Resource held by the map for its href."""
+
+        with self._resources_lock:
+            existing = self._resources.setdefault(resource.href, resource)
+        if existing is not resource:
+            existing._fill(resource.data)
+        return existing
+
+    def forget_resources(self, href=None):
+        """Remove href, or every href if None, from the identity map used
+        by get_resource()."""
+
+        with self._resources_lock:
+            if href is None:
+                self._resources.clear()
+            else:
+                self._resources.pop(href, None)
+
     def _get_simple_model(self, href=None):
         """Get a model
         'href' the relative href to the model. May not be None.
@@ -355,18 +592,66 @@ class Client(object):
 
         return self._parse_json(raw_result.json)
 
+    def _get_coalesced(self, path, data=None):
+        """Execute a GET through the client's single-flight group, so
+        that concurrent identical requests share one HTTP request.
+        Requests are identical when they have the same priority class,
+        path and query, the 'embed' value being compared as a set, so
+        callers never wait behind the queue of a lower priority class.
+
+        Returns the raw JSON returned by the API. Each caller parses its
+        own copy, so results are never shared between callers.
+        If the response status is not 2xx, throws an APIRequestException,
+        the same instance for every coalesced caller.
+        Raises urllib3.exceptions.HTTPError
+        """
+
+        key = (get_priority() or self.scheduler.default_class, _request_key(path, data))
+        return self._single_flight.do(key, self._get_json, path, data)
+
+    def _get_json(self, path, data=None):
+        """Execute a GET and return the raw JSON.
+        If the response status is not 2xx, throws an APIRequestException.
+        Raises urllib3.exceptions.HTTPError
+        """
+
+        raw_result = self.get(path, data)
+
+        if raw_result.status < 200 or raw_result.status > 202:
+            raise APIRequestException(raw_result.status, raw_result.json)
+
+        return raw_result.json
+
+    def get_coalesced_count(self):
+        """Returns the number of requests that were not sent because an
+        identical request was already in flight."""
+        return self._single_flight.get_coalesced_count()
+
+    def priority(self, name):
+        """Context manager giving the requests made inside it the priority
+        class 'name', for example 'interactive' or 'batch'. See
+        clarify_cody.scheduler.priority()."""
+        return priority_scope(name)
+
+    def get_scheduler_stats(self):
+        """Returns the queue depth and wait times of every priority class,
+        see RequestScheduler.get_stats()."""
+        return self.scheduler.get_stats()
+
     def _get_headers(self):
         """Get all the headers we're going to need:
         1. Authorization
         2. Content-Type
         3. User-agent
+        4. Accept-Encoding
         Note that the User-agent string contains the library name, the
         libary version, and the python version. This will help us track
         what people are using, and where we should concentrate our
         development efforts."""
 
         headers = {'User-Agent': self.user_agent,
-                   'Content-Type': 'application/json'}
+                   'Content-Type': 'application/json',
+                   'Accept-Encoding': self._accept_encoding}
         if self.key:
             headers['Authorization'] = 'Bearer ' + self.key
         return headers
@@ -387,13 +672,7 @@ class Client(object):
         # Argument error checking.
         assert path is not None
 
-        response = self.conn.request('GET', path, data, self._get_headers())
-
-        # Extract the result.
-        self._last_status = response_status = response.status
-        response_content = response.data.decode()
-
-        return Result(status=response_status, json=response_content)
+        return self._request('GET', path, fields=data)
 
     def post(self, path, data):
         """Executes a POST.
@@ -417,13 +696,7 @@ class Client(object):
         else:
             data = json.dumps(data)
 
-        response = self.conn.request('POST', path, body=data, headers=self._get_headers())
-
-        # Extract the result.
-        self._last_status = response_status = response.status
-        response_content = response.data.decode()
-
-        return Result(status=response_status, json=response_content)
+        return self._request('POST', path, body=data)
 
     def delete(self, path):
         """Executes a DELETE.
@@ -440,15 +713,7 @@ class Client(object):
         assert path is not None
 
         # Execute the request.
-        response = self.conn.request('DELETE', path, None,
-                                     self._get_headers())
-
-        # Extract the result.
-        self._last_status = response_status = response.status
-        response_content = response.data.decode()
-
-        # return (status, json)
-        return Result(status=response_status, json=response_content)
+        return self._request('DELETE', path)
 
     def put(self, path, data):
         """Executes a PUT.
@@ -472,13 +737,152 @@ class Client(object):
         else:
             data = json.dumps(data)
 
-        response = self.conn.request('PUT', path, body=data, headers=self._get_headers())
+        return self._request('PUT', path, body=data)
+
+    def _request(self, method, path, fields=None, body=None):
+        """Executes a request. Every request made by the client goes
+        through here.
+        'fields' may be None or a dictionary of query parameters.
+        'body' may be None or the encoded request body.
+
+        Returns a Result.
+        If the response can't be decompressed, throws an APIDataException.
+        Raises urllib3.exceptions.HTTPError
+        """
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        headers = self._get_headers()
+        urlopen_kw = {}
+        sent = sent_uncompressed = 0
+        if body is not None:
+            body = body.encode('utf-8')
+            sent = sent_uncompressed = len(body)
+            if self.compress_requests and sent_uncompressed >= self.compress_min_size:
+                body = compress_body(body)
+                headers['Content-Encoding'] = 'gzip'
+                sent = len(body)
+            urlopen_kw['body'] = body
+
+        from .connection import pop_connect_timings
+
+        with self.scheduler.slot(get_priority()):
+            pop_connect_timings()
+            start = time.monotonic()
+            response = self.conn.request(method, path, fields, headers,
+                                         preload_content=False, decode_content=False, **urlopen_kw)
+            first_byte = time.monotonic()
+            try:
+                # Extract the result.
+                self._last_status = response_status = response.status
+                received, content = self._read_body(response)
+            finally:
+                response.release_conn()
+            end = time.monotonic()
+            connects = pop_connect_timings()
+
+        timings = {'dns': sum(c['dns'] for c in connects),
+                   'connect': sum(c['connect'] for c in connects),
+                   'tls': sum(c['tls'] for c in connects),
+                   'new_connection': len(connects) > 0,
+                   'resumed': any(c['resumed'] for c in connects)}
+        connecting = timings['dns'] + timings['connect'] + timings['tls']
+        timings['first_byte'] = max(0.0, first_byte - start - connecting)
+        timings['total'] = end - start
+        self._last_timings = timings
+
+        self.transfer_stats.add(requests=1,
+                                bytes_sent=sent,
+                                bytes_sent_uncompressed=sent_uncompressed,
+                                bytes_received=received,
+                                bytes_received_uncompressed=len(content),
+                                connections=len(connects),
+                                resumed_connections=sum(1 for c in connects if c['resumed']),
+                                dns_seconds=timings['dns'],
+                                connect_seconds=timings['connect'],
+                                tls_seconds=timings['tls'],
+                                first_byte_seconds=timings['first_byte'],
+                                total_seconds=timings['total'])
+
+        return Result(status=response_status, json=content.decode())
+
+    def _read_body(self, response):
+        """Read the body of a response, decompressing it as it streams in.
+        Returns the number of bytes read and the decompressed body."""
+
+        try:
+            decoder = get_decoder(response.headers.get('Content-Encoding'))
+        except ValueError as exception:
+            raise APIDataException(exception, None, str(exception))
+
+        received = 0
+        chunks = []
+        try:
+            for chunk in response.stream(READ_CHUNK_SIZE, decode_content=False):
+                received += len(chunk)
+                chunks.append(decoder.decompress(chunk) if decoder is not None else chunk)
+            if decoder is not None:
+                chunks.append(decoder.flush())
+        except DecodeError as exception:
+            raise APIDataException(exception, None, 'Unable to decompress response.')
+
+        return received, b''.join(chunks)
+
+    def get_transfer_stats(self):
+        """Returns the number of requests and of body bytes sent and
+        received, compressed and uncompressed, see TransferStats, and the
+        number of connections opened ('connections', 'resumed_connections')
+        and the total time in seconds spent in every phase of the requests
+        ('dns_seconds', 'connect_seconds', 'tls_seconds',
+        'first_byte_seconds', 'total_seconds')."""
+        return self.transfer_stats.get()
+
+    def get_last_timings(self):
+        """Returns the timing breakdown of the most recent request made by
+        the client, in seconds: 'dns', 'connect' and 'tls' when it had to
+        open a connection ('new_connection', 'resumed' when the TLS session
+        was resumed), 'first_byte' the wait for the response headers,
+        and 'total'. Returns None before the first request."""
+        return self._last_timings
+
+    def warm_up(self, n=None):
+        """Open up to n connections (the client's maxsize if None) in
+        parallel and put them in the connection pool, so that the first
+        requests don't pay for name resolution, connection and TLS
+        handshake.
+
+        Returns the list of the connection timings, see
+        get_last_timings().
+        Raises urllib3.exceptions.HTTPError
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+        from .connection import pop_connect_timings
+
+        n = min(n or self.maxsize, self.maxsize)
+        assert n > 0
 
-        # Extract the result.
-        self._last_status = response_status = response.status
-        response_content = response.data.decode()
+        conns = [self.conn._get_conn() for _ in range(n)]
 
-        return Result(status=response_status, json=response_content)
+        def connect(conn):
+            pop_connect_timings()
+            if conn.sock is None:
+                conn.connect()
+            connects = pop_connect_timings()
+            if hasattr(conn, 'read_session_tickets') and len(connects) > 0:
+                # Tickets come about one round trip after the handshake.
+                conn.read_session_tickets(min(1.0, connects[0]['tls'] + 0.05))
+            return connects
+
+        try:
+            with ThreadPoolExecutor(max_workers=n) as executor:
+                timings = list(executor.map(connect, conns))
+        finally:
+            for conn in conns:
+                self.conn._put_conn(conn)
+
+        return [t for connects in timings for t in connects]
 
     def _parse_json(self, jstring=None):
         """Parse jstring and return a Python data structure.
@@ -500,6 +904,52 @@ class Client(object):
         return result
 
 
+def _new_connection_pool(host, port, tls, maxsize):
+    """Create the urllib3 connection pool of a client. urllib3 and the TLS
+    support are imported here, the first time a client is created."""
+
+    import urllib3
+    from .connection import TimedHTTPConnection, TimedHTTPSConnection, get_ssl_context
+
+    if tls:
+        import certifi
+        # The SSL context is shared by the whole process, so that TLS
+        # sessions are resumed across connections and clients. It already
+        # holds the CA certificates and requires verification: passing
+        # ca_certs too would make urllib3 reload them on every connection.
+        pool = urllib3.HTTPSConnectionPool(host, port=port, maxsize=maxsize,
+                                           ssl_context=get_ssl_context(certifi.where()))
+        pool.ConnectionCls = TimedHTTPSConnection
+    else:
+        pool = urllib3.HTTPConnectionPool(host, port=port, maxsize=maxsize)
+        pool.ConnectionCls = TimedHTTPConnection
+    return pool
+
+
+def _embed_set(embed):
+    """Returns the set of relations in an 'embed' argument: None, a
+    '+' separated string or a list."""
+
+    if embed is None:
+        return frozenset()
+    if isinstance(embed, str):
+        embed = embed.split('+')
+    return frozenset(e for e in embed if e)
+
+
+def _request_key(path, data=None):
+    """Build the single-flight key of a GET: the path and the query
+    fields, with 'embed' reduced to the set of embedded relations."""
+
+    fields = []
+    if data is not None:
+        for name, value in data.items():
+            if name == 'embed':
+                value = _embed_set(str(value))
+            fields.append((name, value))
+    return (path, frozenset(fields))
+
+
 # This named tuple is returned by get(), put(), post(), delete()
 # functions and consumed by the REST cover functions.
 Result = collections.namedtuple('Result', ['status', 'json'])
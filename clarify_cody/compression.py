@@ -0,0 +1,154 @@
+"""
+.. module:: clarify_cody.compression
+   : synopsis: 'Compressed transfer support'
+"""
+
+import importlib
+import threading
+import zlib
+
+# Optional codecs, imported the first time they are needed.
+_codecs = {}
+
+
+def _codec(name):
+    """Returns the module name (brotli or zstandard), or None if it is not
+    installed. The module is imported on the first call."""
+    if name not in _codecs:
+        try:
+            _codecs[name] = importlib.import_module(name)
+        except ImportError:
+            _codecs[name] = None
+    return _codecs[name]
+
+
+def _installed(name):
+    """Returns True if the module name can be imported, without importing
+    it."""
+    if name in _codecs:
+        return _codecs[name] is not None
+    import importlib.util
+    return importlib.util.find_spec(name) is not None
+
+
+class DecodeError(ValueError):
+    """Raised by the decoders on corrupt content."""
+
+
+def accept_encoding():
+    """Returns the value of the Accept-Encoding header: gzip and deflate,
+    and br and zstd when the brotli and zstandard packages are
+    installed."""
+
+    encodings = ['gzip', 'deflate']
+    if _installed('brotli'):
+        encodings.append('br')
+    if _installed('zstandard'):
+        encodings.append('zstd')
+    return ', '.join(encodings)
+
+
+class _ZlibDecoder(object):
+
+    def __init__(self, wbits):
+        self._obj = zlib.decompressobj(wbits)
+
+    def decompress(self, data):
+        try:
+            return self._obj.decompress(data)
+        except zlib.error as exception:
+            raise DecodeError(exception)
+
+    def flush(self):
+        try:
+            return self._obj.flush()
+        except zlib.error as exception:
+            raise DecodeError(exception)
+
+
+class _BrotliDecoder(object):
+
+    def __init__(self, brotli):
+        self._brotli = brotli
+        self._obj = brotli.Decompressor()
+
+    def decompress(self, data):
+        try:
+            if hasattr(self._obj, 'process'):
+                return self._obj.process(data)
+            return self._obj.decompress(data)
+        except self._brotli.error as exception:
+            raise DecodeError(exception)
+
+    def flush(self):
+        return b''
+
+
+class _ZstdDecoder(object):
+
+    def __init__(self, zstandard):
+        self._zstandard = zstandard
+        self._obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data):
+        try:
+            return self._obj.decompress(data)
+        except self._zstandard.ZstdError as exception:
+            raise DecodeError(exception)
+
+    def flush(self):
+        return b''
+
+
+def get_decoder(content_encoding):
+    """Returns a streaming decoder, with decompress(chunk) and flush()
+    methods, for the value of a Content-Encoding header, or None if the
+    content is not encoded.
+    The decoders raise DecodeError on corrupt content.
+    Raises ValueError if the encoding is not supported."""
+
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+    if encoding in ('gzip', 'x-gzip'):
+        return _ZlibDecoder(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return _ZlibDecoder(zlib.MAX_WBITS)
+    if encoding == 'br' and _codec('brotli') is not None:
+        return _BrotliDecoder(_codec('brotli'))
+    if encoding == 'zstd' and _codec('zstandard') is not None:
+        return _ZstdDecoder(_codec('zstandard'))
+    raise ValueError('Unsupported Content-Encoding: {}'.format(content_encoding))
+
+
+def compress_body(body):
+    """Returns body (bytes) compressed with gzip."""
+    import gzip
+    return gzip.compress(body)
+
+
+class TransferStats(object):
+    """Thread-safe counters of the body bytes sent and received by a
+    client: as transferred ('bytes_sent', 'bytes_received') and before
+    compression or after decompression ('bytes_sent_uncompressed',
+    'bytes_received_uncompressed')."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {'requests': 0,
+                          'bytes_sent': 0,
+                          'bytes_sent_uncompressed': 0,
+                          'bytes_received': 0,
+                          'bytes_received_uncompressed': 0}
+
+    def add(self, **counts):
+        """Add counts to the named counters. Unknown counters start at
+        0."""
+        with self._lock:
+            for name, count in counts.items():
+                self._counters[name] = self._counters.get(name, 0) + count
+
+    def get(self):
+        """Returns a dict of counter name -> value."""
+        with self._lock:
+            return dict(self._counters)
@@ -0,0 +1,171 @@
+"""
+.. module:: clarify_cody.connection
+   : synopsis: 'Instrumented connections with TLS session resumption'
+"""
+
+import socket
+import ssl
+import threading
+import time
+
+from urllib3.connection import HTTPConnection, VerifiedHTTPSConnection
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.wait import wait_for_read
+
+_local = threading.local()
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def pop_connect_timings():
+    """Returns the timings of the connections opened by the calling thread
+    since the last call, as a list of dicts (see TimedHTTPConnection), and
+    forgets them."""
+    timings = getattr(_local, 'timings', None)
+    _local.timings = []
+    return timings or []
+
+
+def _record(timings):
+    if getattr(_local, 'timings', None) is None:
+        _local.timings = []
+    _local.timings.append(timings)
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """An SSLContext that keeps the last TLS session of every server and
+    offers it when opening new connections to that server, so the TLS
+    handshake can be abbreviated."""
+
+    def __new__(cls, *args, **kwargs):
+        context = super(ResumingSSLContext, cls).__new__(cls, *args, **kwargs)
+        context._sessions = {}
+        context._sessions_lock = threading.Lock()
+        return context
+
+    def wrap_socket(self, sock, server_hostname=None, **kwargs):
+        with self._sessions_lock:
+            session = self._sessions.get(server_hostname)
+        if session is not None:
+            kwargs.setdefault('session', session)
+        return super(ResumingSSLContext, self).wrap_socket(sock, server_hostname=server_hostname, **kwargs)
+
+    def save_session(self, server_hostname, sock):
+        """Remember the session of sock for server_hostname."""
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            with self._sessions_lock:
+                self._sessions[server_hostname] = session
+
+
+def get_ssl_context(ca_certs):
+    """Returns the process-wide ResumingSSLContext verifying certificates
+    against ca_certs, so that TLS sessions are shared by every connection
+    and every Client of the process."""
+    with _contexts_lock:
+        context = _contexts.get(ca_certs)
+        if context is None:
+            context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.verify_mode = ssl.CERT_REQUIRED
+            context.check_hostname = True
+            context.load_verify_locations(ca_certs)
+            _contexts[ca_certs] = context
+        return context
+
+
+class _TimingMixin(object):
+    """Records how long opening the connection took: the name resolution
+    ('dns'), the TCP connection ('connect') and the TLS handshake ('tls'),
+    in seconds, and whether the TLS session was resumed ('resumed')."""
+
+    timings = None
+
+    def _new_conn(self):
+        start = time.monotonic()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise NewConnectionError(self, 'Failed to establish a new connection: %s' % e)
+        resolved = time.monotonic()
+
+        # Connect to the resolved addresses, in order.
+        dns_host = self._dns_host
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address[4][0]
+                try:
+                    conn = super(_TimingMixin, self)._new_conn()
+                    break
+                except NewConnectionError as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            self._dns_host = dns_host
+
+        self.timings = {'dns': resolved - start,
+                        'connect': time.monotonic() - resolved,
+                        'tls': 0.0,
+                        'resumed': False}
+        return conn
+
+    def connect(self):
+        start = time.monotonic()
+        super(_TimingMixin, self).connect()
+        if self.timings is not None:
+            elapsed = time.monotonic() - start
+            self.timings['tls'] = max(0.0, elapsed - self.timings['dns'] - self.timings['connect'])
+            self.timings['resumed'] = bool(getattr(self.sock, 'session_reused', False))
+            _record(self.timings)
+
+
+class TimedHTTPConnection(_TimingMixin, HTTPConnection):
+    """HTTPConnection recording its connection timings."""
+
+
+class TimedHTTPSConnection(_TimingMixin, VerifiedHTTPSConnection):
+    """VerifiedHTTPSConnection recording its connection timings and
+    saving its TLS session in its ResumingSSLContext."""
+
+    def connect(self):
+        super(TimedHTTPSConnection, self).connect()
+        self._save_session()
+
+    def getresponse(self, *args, **kwargs):
+        response = super(TimedHTTPSConnection, self).getresponse(*args, **kwargs)
+        # TLS 1.3 session tickets arrive after the handshake.
+        self._save_session()
+        return response
+
+    def _save_session(self):
+        if isinstance(self.ssl_context, ResumingSSLContext) and self.sock is not None:
+            self.ssl_context.save_session(self.server_hostname or self.host, self.sock)
+
+    def read_session_tickets(self, timeout):
+        """Wait up to timeout seconds for the TLS 1.3 session tickets the
+        server sends after the handshake, and process them.
+
+        Unread tickets make an idle connection look dropped to the pool,
+        which would then discard it. Returns False if the connection was
+        closed because it received something else.
+        """
+
+        if self.sock is None or not wait_for_read(self.sock, timeout=timeout):
+            return True
+
+        sock_timeout = self.sock.gettimeout()
+        self.sock.settimeout(0.0)
+        try:
+            data = self.sock.recv(1)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            data = None
+        finally:
+            self.sock.settimeout(sock_timeout)
+
+        if data is not None:
+            # Closed by the server, or unexpected data.
+            self.close()
+            return False
+        self._save_session()
+        return True
@@ -0,0 +1,107 @@
+"""
+.. module:: clarify_cody.conversation_cache
+   : synopsis: 'Client-side cache of conversations and their embeds'
+"""
+
+import copy
+import threading
+import time
+
+
+class ConversationCache(object):
+    """Holds conversations by href, together with the set of embedded
+    relations that have been fetched for each of them.
+
+    A relation is 'held' once the API has embedded it, so that it is not
+    requested again. Relations the API had nothing to embed for, such as
+    insights still being processed, are requested again the next time.
+    """
+
+    def __init__(self, ttl=None):
+        """
+        'ttl' the number of seconds a conversation is kept before it is
+        fetched again, with its metadata and embeds. None keeps it until
+        it is discarded.
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _get(self, href):
+        # Must be called with the lock held.
+        entry = self._entries.get(href)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[2] >= self.ttl:
+            del self._entries[href]
+            return None
+        return entry
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, href):
+        with self._lock:
+            return href in self._entries
+
+    def held_embeds(self, href):
+        """Returns the frozenset of relations held for href, or None if
+        the conversation is not cached or has expired."""
+        with self._lock:
+            entry = self._get(href)
+            return None if entry is None else frozenset(entry[1])
+
+    def get_links(self, href):
+        """Returns a copy of the '_links' of the cached conversation, or
+        None if the conversation is not cached."""
+        with self._lock:
+            entry = self._get(href)
+            return None if entry is None else dict(entry[0].get('_links') or {})
+
+    def put(self, href, conversation, embeds):
+        """Cache conversation, fetched with the relations in embeds. This
+        replaces whatever was cached for href. The relations of embeds
+        the conversation doesn't embed are not held."""
+        conversation = dict(conversation)
+        conversation['_embedded'] = dict(conversation.get('_embedded') or {})
+        held = set(e for e in embeds if e in conversation['_embedded'])
+        with self._lock:
+            self._entries[href] = (conversation, held, time.monotonic())
+
+    def merge(self, href, embedded):
+        """Add embedded relations to the cached conversation.
+        'embedded' a dict of relation -> embedded object. Relations with a
+        None object, that the API had nothing to embed for, are not held.
+        Ignored if the conversation is not cached."""
+        with self._lock:
+            entry = self._get(href)
+            if entry is None:
+                return
+            conversation, held = entry[:2]
+            for link_relation, obj in embedded.items():
+                if obj is not None:
+                    conversation['_embedded'][link_relation] = obj
+                    held.add(link_relation)
+
+    def view(self, href, embeds):
+        """Returns a copy of the cached conversation with only the
+        relations in embeds embedded, as if it had been fetched with
+        them, or None if the conversation is not cached."""
+        with self._lock:
+            entry = self._get(href)
+            if entry is None:
+                return None
+            conversation = dict(entry[0])
+            embedded = dict((k, v) for k, v in conversation.pop('_embedded').items() if k in embeds)
+            if embedded:
+                conversation['_embedded'] = embedded
+            return copy.deepcopy(conversation)
+
+    def discard(self, href):
+        """Remove the conversation at href from the cache."""
+        with self._lock:
+            self._entries.pop(href, None)
+
+    def clear(self):
+        """Empty the cache."""
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,154 @@
+"""
+.. module:: clarify_cody.index
+   : synopsis: 'Local external_id to conversation href index'
+"""
+
+import json
+import os
+import threading
+
+
+class MappingFile(object):
+    """Base of the indexes that can be saved to and loaded from a JSON
+    file. Subclasses hold their mapping behind self._lock, and implement
+    _get_mapping() and _update(mapping), called with the lock held.
+    """
+
+    def _get_mapping(self):
+        raise NotImplementedError
+
+    def _update(self, mapping):
+        raise NotImplementedError
+
+    def save(self, path):
+        """Write the index to the JSON file at path. The file is replaced
+        atomically."""
+        with self._lock:
+            data = self._get_mapping()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def update_from_file(self, path):
+        """Merge the mappings saved at path into the index. A missing file
+        is ignored. Returns the number of mappings read."""
+        if not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            data = json.load(f)
+        with self._lock:
+            self._update(data)
+        return len(data)
+
+    @classmethod
+    def load(cls, path):
+        """Returns an index with the mappings saved at path, or an empty
+        index if the file doesn't exist."""
+        index = cls()
+        index.update_from_file(path)
+        return index
+
+
+class ExternalIdIndex(MappingFile):
+    """Maps conversation external_ids to the href of the conversation
+    ('_links.self'). Safe to share between threads and clients.
+
+    The index can be saved to and loaded from a JSON file, so that the
+    mapping survives between runs.
+    """
+
+    def __init__(self, mapping=None):
+        """
+        'mapping' an optional dict of external_id -> href to start with.
+        """
+        self._lock = threading.Lock()
+        self._hrefs = {}
+        self._external_ids = {}
+        if mapping:
+            self._update(mapping)
+
+    def _get_mapping(self):
+        # Must be called with the lock held.
+        return dict(self._hrefs)
+
+    def _update(self, mapping):
+        # Must be called with the lock held.
+        for external_id, href in mapping.items():
+            previous = self._hrefs.get(external_id)
+            if previous is not None:
+                self._external_ids[previous].discard(external_id)
+            self._hrefs[external_id] = href
+            self._external_ids.setdefault(href, set()).add(external_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._hrefs)
+
+    def __contains__(self, external_id):
+        with self._lock:
+            return external_id in self._hrefs
+
+    def get(self, external_id, default=None):
+        """Returns the href for external_id, or default if unknown."""
+        with self._lock:
+            return self._hrefs.get(external_id, default)
+
+    def get_external_ids(self, href):
+        """Returns the sorted list of the external_ids that map to href."""
+        with self._lock:
+            return sorted(self._external_ids.get(href, ()))
+
+    def add(self, external_id, href):
+        """Record that external_id belongs to the conversation at href.
+        Ignored if either value is None."""
+        if external_id is None or href is None:
+            return
+        with self._lock:
+            self._update({external_id: href})
+
+    def remove_href(self, href):
+        """Forget every external_id that maps to href, for example after
+        the conversation has been deleted."""
+        with self._lock:
+            for external_id in self._external_ids.pop(href, ()):
+                del self._hrefs[external_id]
+
+    def add_result(self, result, external_id=None):
+        """Record the mappings found in a result returned by the API: a
+        conversation, or a collection with embedded conversations or
+        item links that carry an 'external_id'.
+        'external_id' the external_id that was queried to get the result.
+        If the result is a collection with a single item and the items do
+        not carry their external_id, that item is attributed to it.
+
+        Returns the number of mappings recorded.
+        """
+
+        if not isinstance(result, dict):
+            return 0
+
+        count = 0
+        links = result.get('_links') or {}
+
+        if 'external_id' in result:
+            self.add(result['external_id'], (links.get('self') or {}).get('href'))
+            return 1
+
+        embedded = (result.get('_embedded') or {}).get('items') or []
+        for item in embedded:
+            if isinstance(item, dict) and 'external_id' in item:
+                self.add(item['external_id'], ((item.get('_links') or {}).get('self') or {}).get('href'))
+                count += 1
+
+        items = links.get('items') or []
+        for item in items:
+            if 'external_id' in item:
+                self.add(item['external_id'], item.get('href'))
+                count += 1
+
+        if count == 0 and external_id is not None and len(items) == 1:
+            self.add(external_id, items[0].get('href'))
+            count = 1
+
+        return count
@@ -0,0 +1,352 @@
+"""
+.. module:: clarify_cody.purge
+   : synopsis: 'Bulk deletion of conversations'
+"""
+
+import argparse
+import contextvars
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+from .errors import APIRequestException
+from .helpers import get_link_href
+from .ratelimit import TokenBucket
+from .resource import Resource
+from .scheduler import BATCH, get_priority, priority as priority_scope
+
+
+class PurgeReport(object):
+    """The outcome of a purge.
+    'scanned' the number of conversations listed.
+    'matched' the hrefs of the conversations the predicate selected.
+    'deleted' the hrefs of the conversations deleted.
+    'failed' a list of (href, exception) for the conversations that
+    couldn't be checked or deleted.
+    'skipped' the number of conversations already deleted by an earlier,
+    interrupted run with the same log.
+    """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.scanned = 0
+        self.matched = []
+        self.deleted = []
+        self.failed = []
+        self.skipped = 0
+
+    def __str__(self):
+        return '{}scanned {}, matched {}, deleted {}, failed {}, skipped {}'.format(
+            'DRY RUN: ' if self.dry_run else '', self.scanned, len(self.matched),
+            len(self.deleted), len(self.failed), self.skipped)
+
+
+class PurgeLog(object):
+    """Append-only log of a purge, one JSON object per line:
+    {"deleted": href}, {"failed": href, "status": status} and
+    {"page": href} once every conversation of a page has been handled,
+    href being the next page to list (null when the listing is over).
+
+    Reopening the log of an interrupted purge gives the hrefs already
+    deleted and the page to continue from.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.deleted = set()
+        self.next_page = None
+        self.finished = False
+
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                content = f.read()
+                if not content.endswith(b'\n'):
+                    # Cut the last line, truncated by the interruption, so
+                    # that the next entry starts on a line of its own.
+                    content = content[:content.rfind(b'\n') + 1]
+                    f.truncate(len(content))
+            for line in content.decode('utf-8').splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if 'deleted' in entry:
+                    self.deleted.add(entry['deleted'])
+                elif 'page' in entry:
+                    self.next_page = entry['page']
+                    self.finished = entry['page'] is None
+
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def _write(self, entry, sync=False):
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def record_deleted(self, href):
+        self._write({'deleted': href})
+
+    def record_failed(self, href, status):
+        self._write({'failed': href, 'status': status})
+
+    def record_page(self, next_href):
+        self._write({'page': next_href}, sync=True)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def purge(client, predicate, concurrency=None, dry_run=False, log_path=None, rate=None, retries=3, limit=None):
+    """Delete every conversation for which predicate returns True.
+
+    'client' a Client.
+    'predicate' called as predicate(conversation) where conversation is
+    a Resource. Its content is only fetched if the predicate accesses it
+    (and is not fetched at all when the listing embeds the items), so
+    predicates that only look at conversation.href cost no request.
+    'concurrency' the number of conversations checked and deleted in
+    parallel. Every request needs one of the client's maxsize connection
+    slots, so it may not exceed the client's maxsize, and defaults to it.
+    'dry_run' if True, nothing is deleted and the log is not written:
+    the report only lists the matching conversations.
+    'log_path' the path of a PurgeLog. A purge interrupted with a log
+    continues from the page it was on when run again with the same log.
+    'rate' the maximum number of deletes per second, or None.
+    'retries' the number of times a delete answered with 429 or 5xx is
+    retried.
+    'limit' the page size of the listing, or None for the API default.
+
+    The requests have the 'batch' priority unless made in a priority()
+    scope.
+
+    Deleting conversations shifts the following ones into the page they
+    were deleted from, so a page is listed again until listing it deletes
+    nothing. The conversations already checked on the page are not
+    checked again.
+
+    Returns a PurgeReport.
+    Raises urllib3.exceptions.HTTPError, APIRequestException or
+    APIDataException if listing fails.
+    """
+
+    concurrency = client._get_concurrency(concurrency)
+
+    if get_priority() is None:
+        with priority_scope(BATCH):
+            return purge(client, predicate, concurrency, dry_run, log_path, rate, retries, limit)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    log = PurgeLog(log_path) if log_path is not None and not dry_run else None
+    purger = _Purger(client, predicate, dry_run, log, TokenBucket(rate) if rate else None, retries)
+    report = purger.report
+
+    page_href = None
+    done = set()
+    if log is not None:
+        page_href = log.next_page
+        done = log.deleted
+        if log.finished:
+            log.close()
+            return report
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            seen = set()
+            while True:
+                page = client.get_conversation_list(page_href, limit)
+                # Finish the page before recording it.
+                if purger.handle_page(executor, page, done, seen) > 0:
+                    # The deletes shifted the following conversations
+                    # into this page: list it again.
+                    continue
+
+                next_href = get_link_href(page, 'next') if '_links' in page else None
+                if log is not None:
+                    log.record_page(next_href)
+                if next_href is None:
+                    break
+                page_href = next_href
+                seen = set()
+    finally:
+        if log is not None:
+            log.close()
+
+    return report
+
+
+class _Purger(object):
+    """Checks and deletes the conversations of a purge, filling its
+    report and log."""
+
+    def __init__(self, client, predicate, dry_run, log, limiter, retries):
+        self.client = client
+        self.predicate = predicate
+        self.dry_run = dry_run
+        self.log = log
+        self.limiter = limiter
+        self.retries = retries
+        self.report = PurgeReport(dry_run)
+        self._lock = threading.Lock()
+
+    def handle_page(self, executor, page, done, seen):
+        """Handle the conversations of a list page in parallel, skipping
+        the hrefs in done and in seen, and wait for them. The handled
+        hrefs are added to seen.
+        Returns the number of conversations deleted."""
+
+        conversations = []
+        for conversation in _page_conversations(self.client, page):
+            if conversation.href in seen:
+                continue
+            seen.add(conversation.href)
+            self.report.scanned += 1
+            if conversation.href in done:
+                self.report.skipped += 1
+            else:
+                conversations.append(conversation)
+
+        # Handle the conversations in this context, to keep its priority.
+        futures = [executor.submit(contextvars.copy_context().run, self.handle, c) for c in conversations]
+        return sum(1 for future in futures if future.result())
+
+    def handle(self, conversation):
+        """Check and delete conversation. Returns True if it was
+        deleted."""
+
+        href = conversation.href
+        try:
+            if not self.predicate(conversation):
+                return False
+        except Exception as exception:
+            self._failed(href, exception)
+            return False
+
+        with self._lock:
+            self.report.matched.append(href)
+        if self.dry_run:
+            return False
+
+        try:
+            self._delete(href)
+        except APIRequestException as exception:
+            if exception.get_http_response() != 404:
+                self._failed(href, exception)
+                return False
+            # Already gone.
+        except Exception as exception:
+            self._failed(href, exception)
+            return False
+
+        with self._lock:
+            self.report.deleted.append(href)
+        if self.log is not None:
+            self.log.record_deleted(href)
+        return True
+
+    def _failed(self, href, exception):
+        with self._lock:
+            self.report.failed.append((href, exception))
+        if self.log is not None:
+            status = exception.get_http_response() if isinstance(exception, APIRequestException) else None
+            self.log.record_failed(href, status)
+
+    def _delete(self, href):
+        """Delete href, waiting for the limiter and retrying on 429 and
+        5xx."""
+
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                self.client.delete_conversation(href)
+                return
+            except APIRequestException as exception:
+                status = exception.get_http_response()
+                if attempt >= self.retries or not (status == 429 or status >= 500):
+                    raise
+                if self.limiter is not None:
+                    self.limiter.pause(2 ** attempt)
+                else:
+                    time.sleep(2 ** attempt)
+                attempt += 1
+
+
+def _page_conversations(client, page):
+    """Returns the conversations of a list page as Resources: the
+    embedded items if any, otherwise lazy Resources for the item links."""
+
+    embedded = (page.get('_embedded') or {}).get('items')
+    if embedded:
+        return [Resource(client, data=item) for item in embedded]
+    return [Resource(client, item['href']) for item in (page.get('_links') or {}).get('items', [])]
+
+
+def older_than(days, field='created', now=None):
+    """Returns a predicate selecting the conversations whose 'field' is an
+    ISO 8601 date or timestamp more than 'days' days before now.
+    Conversations without the field are not selected. Naive timestamps
+    are taken as UTC."""
+
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+    cutoff = now - datetime.timedelta(days=days)
+
+    def predicate(conversation):
+        value = conversation.get(field)
+        if not value:
+            return False
+        timestamp = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        return timestamp < cutoff
+
+    return predicate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Delete the Cody conversations older than a number of days. '
+                                                 'The API key is read from CODY_API_KEY.')
+    parser.add_argument('--older-than', type=float, required=True, metavar='DAYS', dest='days',
+                        help='Delete the conversations older than DAYS days')
+    parser.add_argument('--field', default='created',
+                        help='Conversation field holding the date to compare (default: created)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='Number of conversations handled in parallel (default: 8)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Maximum number of deletes per second')
+    parser.add_argument('--log', default=None, metavar='PATH',
+                        help='Log of the deletions, used to resume an interrupted purge')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='List the conversations that would be deleted, delete nothing')
+    parser.add_argument('--url', default=None,
+                        help='URL of the cody server, ex. https://cody.example.org')
+    args = parser.parse_args(argv)
+    key = os.environ.get('CODY_API_KEY')
+    if not key:
+        parser.error('the CODY_API_KEY environment variable is not set')
+
+    from .client import Client
+
+    client = Client(key, args.url, maxsize=args.concurrency)
+    report = purge(client, older_than(args.days, args.field), concurrency=args.concurrency,
+                   dry_run=args.dry_run, log_path=args.log, rate=args.rate)
+
+    for href in report.matched if args.dry_run else report.deleted:
+        sys.stdout.write(href + '\n')
+    for href, exception in report.failed:
+        sys.stderr.write('FAILED {}: {}\n'.format(href, exception))
+    sys.stderr.write(str(report) + '\n')
+    return 1 if report.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+.. module:: clarify_cody.ratelimit
+   : synopsis: 'Token bucket rate limiting'
+"""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket: allows 'rate' operations per second on
+    average, with bursts of up to 'burst' operations."""
+
+    def __init__(self, rate, burst=None):
+        """
+        'rate' the number of tokens added per second. Must be > 0.
+        'burst' the capacity of the bucket. Defaults to max(1, rate).
+        """
+
+        # Argument error checking.
+        assert rate > 0
+        assert burst is None or burst >= 1
+
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        # Must be called with the lock held.
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _reserve(self, tokens):
+        """Take tokens if available. Returns 0 on success, or the number
+        of seconds to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens=1):
+        """Take tokens without waiting. Returns True if they were taken."""
+        return self._reserve(tokens) == 0
+
+    def acquire(self, tokens=1):
+        """Take tokens, waiting as long as needed. Returns the number of
+        seconds spent waiting."""
+        waited = 0.0
+        while True:
+            delay = self._reserve(tokens)
+            if delay == 0:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next 'seconds' seconds, for example
+        after the server answered 429 Too Many Requests."""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = self._paused_until
@@ -0,0 +1,162 @@
+"""
+.. module:: clarify_cody.resource
+   : synopsis: 'Lazy HAL resources with cached link traversal'
+"""
+
+import json
+import threading
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+from clarify_cody.helpers import get_link_href, get_item_hrefs
+
+
+class Resource(Mapping):
+    """A read-only, lazily loaded HAL resource.
+
+    A Resource holds either the decoded data of a resource, the raw JSON
+    returned by the API, or only the href of the resource. The JSON is
+    decoded, and the href fetched, the first time the content is
+    accessed. Sub-objects returned by embedded() and follow() are
+    wrapped without being copied.
+
+    Resources behave like the read-only dicts returned by the Client, so
+    they can be passed to the functions in clarify_cody.helpers.
+
+    Links are resolved through the identity map of the client (see
+    Client.get_resource()), so that an href is fetched and parsed at most
+    once per client. Embedded resources are used instead of the network
+    whenever they are present.
+    """
+
+    def __init__(self, client=None, href=None, data=None, raw=None):
+        """
+        'client' the Client used to resolve links. May be None if the
+        resource is never loaded from its href or followed.
+        'href' the href of the resource.
+        'data' the decoded resource, or None.
+        'raw' the raw JSON of the resource, or None.
+        """
+        self._client = client
+        self._href = href
+        self._data = data
+        self._json = raw
+        self._lock = threading.Lock()
+
+    def _load(self):
+        data = self._data
+        if data is not None:
+            return data
+
+        with self._lock:
+            if self._data is None:
+                if self._json is None:
+                    assert self._client is not None and self._href is not None
+                    self._json = self._client._get_coalesced(self._href)
+                self._data = self._decode(self._json)
+                self._json = None
+            return self._data
+
+    def _decode(self, jstring):
+        if self._client is not None:
+            return self._client._parse_json(jstring)
+        return json.loads(jstring)
+
+    def _fill(self, data):
+        """Provide the content of a resource that hasn't been loaded yet,
+        so that it doesn't need to be fetched."""
+        with self._lock:
+            if self._data is None:
+                self._data = data
+                self._json = None
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._data is not None else 'lazy'
+        return '<Resource {} ({})>'.format(self.href, state)
+
+    @property
+    def loaded(self):
+        """True once the resource has been decoded."""
+        return self._data is not None
+
+    @property
+    def data(self):
+        """The decoded resource, as returned by the API."""
+        return self._load()
+
+    @property
+    def href(self):
+        """The href of the resource: the one it was created with, or its
+        'self' link."""
+        if self._href is None and (self._data is not None or self._json is not None):
+            links = self._load().get('_links')
+            if links and links.get('self'):
+                self._href = links['self'].get('href')
+        return self._href
+
+    def link_href(self, link_relation):
+        """Returns the href of link_relation, or None if the resource
+        has no such link."""
+        if '_links' not in self._load():
+            return None
+        return get_link_href(self._load(), link_relation)
+
+    def item_hrefs(self):
+        """Returns the list of item hrefs of a collection resource."""
+        return get_item_hrefs(self._load())
+
+    def embedded(self, link_relation):
+        """Returns the embedded resource for link_relation (a list of
+        Resources if the relation embeds several), or None if nothing is
+        embedded for it."""
+        embedded = (self._load().get('_embedded') or {}).get(link_relation)
+        if embedded is None:
+            return None
+        if isinstance(embedded, list):
+            return [self._wrap(e) for e in embedded]
+        return self._wrap(embedded)
+
+    def follow(self, link_relation):
+        """Returns the resource that link_relation points to: the
+        embedded resource if present, otherwise the resource from the
+        client's identity map, which is fetched when first accessed.
+        Links with several targets give a list of Resources.
+        Returns None if the resource has neither an embedded resource nor
+        a link for link_relation.
+        """
+        embedded = self.embedded(link_relation)
+        if embedded is not None:
+            return embedded
+
+        link = (self._load().get('_links') or {}).get(link_relation)
+        if link is None:
+            return None
+        if isinstance(link, list):
+            return [self._client.get_resource(i['href']) for i in link]
+        return self._client.get_resource(link['href'])
+
+    def follow_items(self):
+        """Returns the items of a collection resource as a list of
+        Resources, embedded or fetched when first accessed."""
+        items = self.follow('items')
+        return items if items is not None else []
+
+    def _wrap(self, data):
+        if not isinstance(data, dict):
+            return data
+        resource = Resource(self._client, data=data)
+        if self._client is not None and resource.href is not None:
+            # Known content, don't fetch it again when linked to.
+            return self._client._add_resource(resource)
+        return resource
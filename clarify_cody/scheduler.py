@@ -0,0 +1,148 @@
+"""
+.. module:: clarify_cody.scheduler
+   : synopsis: 'Priority scheduling of requests over pooled connections'
+"""
+
+import contextlib
+import contextvars
+import threading
+import time
+from collections import deque
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+DEFAULT_WEIGHTS = {INTERACTIVE: 8, BATCH: 1}
+
+_priority = contextvars.ContextVar('clarify_cody_priority', default=None)
+
+
+def get_priority():
+    """Returns the priority class set by the innermost priority() scope,
+    or None outside of any scope."""
+    return _priority.get()
+
+
+@contextlib.contextmanager
+def priority(name):
+    """Context manager tagging the requests made inside it, by any client
+    in the current thread or asyncio task, with the priority class
+    'name'."""
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class _Class(object):
+    """Queue and counters of one priority class."""
+
+    def __init__(self, weight):
+        self.weight = float(weight)
+        self.finish = 0.0
+        self.waiting = deque()
+        self.in_flight = 0
+        self.dispatched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class RequestScheduler(object):
+    """Hands out a fixed number of request slots, normally one per pooled
+    connection, to priority classes by weighted fair queuing.
+
+    While requests are waiting, each class gets slots in proportion to
+    its weight: with the default weights, interactive requests get 8
+    slots for every slot given to batch requests. Idle classes don't
+    accumulate credit.
+    """
+
+    def __init__(self, slots=1, weights=None):
+        """
+        'slots' the number of requests allowed in flight at once.
+        'weights' a dict of priority class -> weight. Defaults to
+        DEFAULT_WEIGHTS.
+        """
+
+        # Argument error checking.
+        assert slots > 0
+
+        self.slots = slots
+        self.default_class = INTERACTIVE
+        self._classes = dict((name, _Class(weight))
+                             for name, weight in (weights or DEFAULT_WEIGHTS).items())
+        self._free = slots
+        self._clock = 0.0
+        self._cond = threading.Condition()
+
+    def _dispatch(self, cls):
+        # Must be called with the lock held.
+        start = max(cls.finish, self._clock)
+        cls.finish = start + 1.0 / cls.weight
+        self._clock = start
+        cls.in_flight += 1
+        cls.dispatched += 1
+
+    def acquire(self, name=None):
+        """Wait for a slot for the priority class 'name' (the default class
+        if None). Returns the number of seconds spent waiting."""
+
+        name = name or self.default_class
+        assert name in self._classes, 'Unknown priority class: {}'.format(name)
+
+        with self._cond:
+            cls = self._classes[name]
+            if self._free > 0 and not any(c.waiting for c in self._classes.values()):
+                self._free -= 1
+                self._dispatch(cls)
+                return 0.0
+
+            ticket = [False]
+            cls.waiting.append(ticket)
+            start = time.monotonic()
+            while not ticket[0]:
+                self._cond.wait()
+            waited = time.monotonic() - start
+            cls.total_wait += waited
+            cls.max_wait = max(cls.max_wait, waited)
+            return waited
+
+    def release(self, name=None):
+        """Give back a slot taken by acquire(name)."""
+
+        name = name or self.default_class
+        with self._cond:
+            self._classes[name].in_flight -= 1
+            waiting = [c for c in self._classes.values() if c.waiting]
+            if len(waiting) == 0:
+                self._free += 1
+                return
+            cls = min(waiting, key=lambda c: max(c.finish, self._clock))
+            cls.waiting.popleft()[0] = True
+            self._dispatch(cls)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, name=None):
+        """Context manager holding a slot for the priority class 'name'."""
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def get_stats(self):
+        """Returns a dict of priority class -> dict with the current queue
+        depth ('queued') and number of requests in flight, the number of
+        requests dispatched, and the total, average and maximum time in
+        seconds spent waiting for a slot."""
+
+        with self._cond:
+            return dict((name, {'queued': len(c.waiting),
+                                'in_flight': c.in_flight,
+                                'dispatched': c.dispatched,
+                                'total_wait': c.total_wait,
+                                'avg_wait': c.total_wait / c.dispatched if c.dispatched else 0.0,
+                                'max_wait': c.max_wait})
+                        for name, c in self._classes.items())
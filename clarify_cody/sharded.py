@@ -0,0 +1,543 @@
+"""
+.. module:: clarify_cody.sharded
+   : synopsis: 'Client spreading requests over several API keys and endpoints'
+"""
+
+import bisect
+import contextvars
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import urllib3
+
+from .client import Client
+from .errors import APIRequestException
+from .helpers import get_item_hrefs, get_link_href
+from .index import ExternalIdIndex, MappingFile
+from .ratelimit import TokenBucket
+from .scheduler import BATCH, get_priority, priority as priority_scope
+
+from clarify_cody.constants import __host__
+
+
+class Shard(object):
+    """A Client for one (key, url) pair, with its health and rate state.
+
+    A shard is considered down after 'max_failures' consecutive failures
+    (transport errors, 5xx and 429 responses), and is given requests
+    again once 'cooldown' seconds have passed. A 429 response also pauses
+    the rate limiter of the client, if it has one.
+    """
+
+    def __init__(self, name, client, max_failures=3, cooldown=30.0):
+        """
+        'name' identifies the shard on the hash ring.
+        'client' the Client used to talk to the shard.
+        """
+        self.name = name
+        self.client = client
+        self.limiter = client.rate_limiter
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._failures = 0
+        self._down_until = 0.0
+        self._requests = 0
+        self._errors = 0
+
+    def is_healthy(self):
+        """Returns False while the shard is down."""
+        with self._lock:
+            return time.monotonic() >= self._down_until
+
+    def in_flight(self):
+        """Returns the number of requests in progress on the shard."""
+        with self._lock:
+            return self._in_flight
+
+    def call(self, method_name, *args, **kwargs):
+        """Call a method of the shard's client, updating the rate and
+        health state of the shard. Returns what the method returns and
+        raises what it raises."""
+
+        with self._lock:
+            self._in_flight += 1
+            self._requests += 1
+        try:
+            result = getattr(self.client, method_name)(*args, **kwargs)
+        except APIRequestException as exception:
+            status = exception.get_http_response()
+            if status == 429:
+                if self.limiter is not None:
+                    self.limiter.pause(1.0)
+                self._record(False)
+            else:
+                self._record(status < 500)
+            raise
+        except urllib3.exceptions.HTTPError:
+            self._record(False)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+        self._record(True)
+        return result
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self._failures = 0
+                return
+            self._errors += 1
+            self._failures += 1
+            if self._failures >= self.max_failures:
+                self._down_until = time.monotonic() + self.cooldown
+                self._failures = 0
+
+    def get_stats(self):
+        """Returns a dict with the state of the shard."""
+        with self._lock:
+            return {'healthy': time.monotonic() >= self._down_until,
+                    'in_flight': self._in_flight,
+                    'requests': self._requests,
+                    'errors': self._errors}
+
+
+class HashRing(object):
+    """Consistent hash ring, with 'vnodes' points per unit of weight for
+    every node."""
+
+    def __init__(self, vnodes=64):
+        self.vnodes = vnodes
+        self._points = []
+        self._nodes = []
+
+    def add(self, name, node, weight=1):
+        """Add node to the ring. Its points are derived from 'name'."""
+        for i in range(int(self.vnodes * weight)):
+            point = _hash('{}#{}'.format(name, i))
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._nodes.insert(index, node)
+
+    def walk(self, key):
+        """Yield the distinct nodes in ring order starting at the owner of
+        key."""
+        if len(self._points) == 0:
+            return
+        start = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        seen = set()
+        for i in range(len(self._points)):
+            node = self._nodes[(start + i) % len(self._points)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class ShardOwnerIndex(MappingFile):
+    """Maps conversation hrefs to the name of the shard that created or
+    found them. Safe to share between threads and clients.
+
+    Like ExternalIdIndex, the index can be saved to and loaded from a
+    JSON file, so that conversations keep going through their shard
+    between runs. Shard names depend on the order of the shards, see
+    ShardedClient.
+    """
+
+    def __init__(self, mapping=None):
+        """
+        'mapping' an optional dict of href -> shard name to start with.
+        """
+        self._lock = threading.Lock()
+        self._names = dict(mapping or {})
+
+    def _get_mapping(self):
+        # Must be called with the lock held.
+        return dict(self._names)
+
+    def _update(self, mapping):
+        # Must be called with the lock held.
+        self._names.update(mapping)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._names)
+
+    def get(self, href, default=None):
+        """Returns the name of the shard owning href, or default if
+        unknown."""
+        with self._lock:
+            return self._names.get(href, default)
+
+    def add(self, href, name):
+        """Record that the conversation at href belongs to the shard
+        'name'. Ignored if href is None."""
+        if href is None:
+            return
+        with self._lock:
+            self._names[href] = name
+
+    def remove_href(self, href):
+        """Forget the owner of href."""
+        with self._lock:
+            self._names.pop(href, None)
+
+
+class ShardedClient(object):
+    """Spreads requests over several API keys and/or endpoints, each
+    holding its own, disjoint, set of conversations.
+
+    A conversation is owned by the shard it was created, listed or found
+    on, and requests about it always go through that shard. Owners are
+    found, in order:
+    - in the owner_index, where every created, listed or found
+      conversation is recorded;
+    - by consistent hashing on the conversation's external_id, from the
+      external_id_index, as conversations with an external_id are
+      created and looked up on the shard of their external_id;
+    - by consistent hashing on the href.
+    Consistent hashing skips unhealthy shards. Saving both indexes and
+    passing them to the next ShardedClient keeps the routing across runs.
+    Requests with no routing key, including the creation of
+    conversations without an external_id, go to the healthy shard with
+    the fewest requests in flight.
+
+    conversation_list_map() and purge() go through the listings of all
+    the shards.
+
+    Exposes the methods of Client.
+    """
+
+    def __init__(self, shards, maxsize=1, rate=None, vnodes=64, max_failures=3, cooldown=30.0,
+                 external_id_index=None, conversation_cache=None, owner_index=None):
+        """
+        'shards' a list of (key, url) pairs. The url may be None.
+        'maxsize' the connection pool size of every shard.
+        'rate' the maximum number of requests per second of every shard,
+        or None.
+        'vnodes' the number of points of every shard on the hash ring.
+        'max_failures' and 'cooldown', see Shard.
+        'external_id_index' and 'conversation_cache' are shared by the
+        clients of all the shards, see Client.
+        'owner_index' a ShardOwnerIndex recording the shard of every
+        conversation. If None, the client gets its own.
+        """
+
+        # Argument error checking.
+        assert len(shards) > 0
+
+        if external_id_index is None:
+            external_id_index = ExternalIdIndex()
+        self.external_id_index = external_id_index
+
+        if owner_index is None:
+            owner_index = ShardOwnerIndex()
+        self.owner_index = owner_index
+
+        self.shards = []
+        self._shards_by_name = {}
+        self._ring = HashRing(vnodes)
+        for i, (key, url) in enumerate(shards):
+            client = Client(key, url, maxsize=maxsize, external_id_index=external_id_index,
+                            conversation_cache=conversation_cache,
+                            rate_limiter=TokenBucket(rate) if rate else None)
+            shard = Shard('{}:{}'.format(i, url or __host__), client, max_failures, cooldown)
+            self.shards.append(shard)
+            self._shards_by_name[shard.name] = shard
+            self._ring.add(shard.name, shard)
+
+        self._local = threading.local()
+
+    def _route(self, href=None):
+        """Returns the shard owning the conversation at href, or the least
+        busy healthy shard if href is None."""
+
+        if href is None:
+            candidates = [s for s in self.shards if s.is_healthy()] or self.shards
+            return min(candidates, key=lambda s: s.in_flight())
+
+        owner = self._shards_by_name.get(self.owner_index.get(href))
+        if owner is not None:
+            return owner
+
+        external_ids = self.external_id_index.get_external_ids(href)
+        return self._hash_route(external_ids[0] if len(external_ids) > 0 else href)
+
+    def _route_external_id(self, external_id):
+        """Returns the shard owning the conversation of external_id: the
+        owner of its href when the external_id_index knows it."""
+
+        href = self.external_id_index.get(external_id)
+        if href is not None:
+            return self._route(href)
+        return self._hash_route(external_id)
+
+    def _hash_route(self, key):
+        """Returns the first healthy shard for key on the hash ring."""
+
+        first = None
+        for shard in self._ring.walk(key):
+            if first is None:
+                first = shard
+            if shard.is_healthy():
+                return shard
+        return first
+
+    def _set_owner(self, href, shard, replace=False):
+        """Record shard as the owner of href. A known owner is only
+        replaced if 'replace' is True."""
+        if replace or self.owner_index.get(href) is None:
+            self.owner_index.add(href, shard.name)
+
+    def _call(self, shard, method_name, *args, **kwargs):
+        try:
+            return shard.call(method_name, *args, **kwargs)
+        finally:
+            self._local.last_status = shard.client.get_last_status()
+            self._local.last_timings = shard.client.get_last_timings()
+
+    def _map_shards(self, func):
+        """Call func(shard) for every shard in parallel, in the caller's
+        context. Returns the list of the results, in shard order."""
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, func, s) for s in self.shards]
+            return [f.result() for f in futures]
+
+    def get_shard(self, key=None):
+        """Returns the Shard that requests for key (an href or an
+        external_id) are sent to."""
+        if key is not None and key in self.external_id_index:
+            return self._route_external_id(key)
+        return self._route(key)
+
+    def get_conversation_list(self, href=None, limit=None, shard=None):
+        """See Client.get_conversation_list(). Lists the conversations of
+        one shard and records it as their owner.
+        'shard' the Shard to list. Pass the shard of a page to follow its
+        links. Defaults to the least busy shard.
+        """
+        if shard is None:
+            shard = self._route(None)
+        result = self._call(shard, 'get_conversation_list', href, limit)
+        for item_href in get_item_hrefs(result):
+            self._set_owner(item_href, shard)
+        return result
+
+    def conversation_list_map(self, func, conversation_collection=None):
+        """See Client.conversation_list_map(). Func is called as
+        func(sharded_client, conversation_href).
+
+        If conversation_collection is None, the conversations of every
+        shard are iterated, one shard after the other. Otherwise the
+        following pages are listed from the shard owning the first
+        conversation of the collection."""
+
+        if get_priority() is None:
+            with priority_scope(BATCH):
+                return self.conversation_list_map(func, conversation_collection)
+
+        if conversation_collection is not None:
+            hrefs = get_item_hrefs(conversation_collection)
+            shard = self._route(hrefs[0] if len(hrefs) > 0 else None)
+            self.external_id_index.add_result(conversation_collection)
+            return self._list_map(shard, func, conversation_collection)[0]
+
+        total = 0
+        for shard in self.shards:
+            count, stopped = self._list_map(shard, func)
+            total += count
+            if stopped:
+                break
+        return total
+
+    def _list_map(self, shard, func, conversation_collection=None):
+        """Call func on the conversations listed by shard, starting with
+        conversation_collection if given. Returns the number of
+        conversations iterated, and whether func stopped the iteration."""
+
+        total = 0
+        next_href = None
+        while True:
+            if conversation_collection is None:
+                conversation_collection = self.get_conversation_list(next_href, shard=shard)
+
+            for href in get_item_hrefs(conversation_collection):
+                total += 1
+                if func(self, href) is False:
+                    return total, True
+
+            next_href = get_link_href(conversation_collection, 'next')
+            if next_href is None:
+                return total, False
+            conversation_collection = None
+
+    def create_conversation(self, external_id=None, participants=None, options=None, notify_url=None):
+        """See Client.create_conversation(). Routed by external_id."""
+        shard = self._route(None) if external_id is None else self._route_external_id(external_id)
+        result = self._call(shard, 'create_conversation', external_id, participants, options, notify_url)
+        self._set_owner(((result.get('_links') or {}).get('self') or {}).get('href'), shard, replace=True)
+        return result
+
+    def get_conversation(self, href=None, embed=None, refresh=False):
+        """See Client.get_conversation()."""
+        assert href is not None
+        return self._call(self._route(href), 'get_conversation', href, embed, refresh)
+
+    def get_conversation_for_external_id(self, external_id, embed=None):
+        """See Client.get_conversation_for_external_id(). Routed by
+        external_id."""
+        assert external_id is not None
+        shard = self._route_external_id(external_id)
+        result = self._call(shard, 'get_conversation_for_external_id', external_id, embed)
+        self._set_owner(self.external_id_index.get(external_id), shard)
+        return result
+
+    def resolve_external_ids(self, external_ids, concurrency=None):
+        """See Client.resolve_external_ids(). The lookups of every shard
+        run in parallel, each shard sending up to 'concurrency' of them
+        at a time."""
+
+        result = {}
+        groups = {}
+        for external_id in external_ids:
+            if external_id in result:
+                continue
+            result[external_id] = self.external_id_index.get(external_id)
+            if result[external_id] is None:
+                groups.setdefault(self._hash_route(external_id), []).append(external_id)
+
+        if len(groups) == 0:
+            return result
+
+        def resolve(item):
+            shard, ids = item
+            hrefs = self._call(shard, 'resolve_external_ids', ids, concurrency)
+            for href in hrefs.values():
+                self._set_owner(href, shard)
+            return hrefs
+
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, resolve, i) for i in groups.items()]
+            for future in futures:
+                result.update(future.result())
+        return result
+
+    def delete_conversation(self, href=None):
+        """See Client.delete_conversation()."""
+        assert href is not None
+        self._call(self._route(href), 'delete_conversation', href)
+        self.owner_index.remove_href(href)
+
+    def purge(self, predicate, concurrency=None, dry_run=False, log_path=None, rate=None, retries=3, limit=None):
+        """See Client.purge(). Every shard purges the conversations it
+        lists, in parallel, with up to 'concurrency' deletes in flight,
+        the maxsize of the shards by default. As the shards hold disjoint
+        conversations (see ShardedClient), every conversation is checked
+        and deleted once, by its owner.
+        With a log_path, shard i logs to log_path + '.i'.
+
+        Returns a PurgeReport summing those of the shards.
+        Raises urllib3.exceptions.HTTPError
+        """
+
+        from .purge import PurgeReport
+
+        def purge(shard):
+            i = self.shards.index(shard)
+            return shard.client.purge(predicate, concurrency, dry_run,
+                                      None if log_path is None else '{}.{}'.format(log_path, i),
+                                      rate, retries, limit)
+
+        report = PurgeReport(dry_run)
+        for shard_report in self._map_shards(purge):
+            report.scanned += shard_report.scanned
+            report.matched.extend(shard_report.matched)
+            report.deleted.extend(shard_report.deleted)
+            report.failed.extend(shard_report.failed)
+            report.skipped += shard_report.skipped
+        for href in report.deleted:
+            self.owner_index.remove_href(href)
+        return report
+
+    def get(self, path, data=None):
+        """See Client.get(). Routed by path."""
+        assert path is not None
+        return self._call(self._route(path), 'get', path, data)
+
+    def post(self, path, data):
+        """See Client.post(). Routed by path."""
+        assert path is not None
+        return self._call(self._route(path), 'post', path, data)
+
+    def put(self, path, data):
+        """See Client.put(). Routed by path."""
+        assert path is not None
+        return self._call(self._route(path), 'put', path, data)
+
+    def delete(self, path):
+        """See Client.delete(). Routed by path."""
+        assert path is not None
+        return self._call(self._route(path), 'delete', path)
+
+    def get_resource(self, href=None):
+        """See Client.get_resource(). Resources come from the identity map
+        of the shard that owns href."""
+        assert href is not None
+        return self._route(href).client.get_resource(href)
+
+    def forget_resources(self, href=None):
+        """See Client.forget_resources()."""
+        for shard in self.shards:
+            shard.client.forget_resources(href)
+
+    def get_last_status(self):
+        """Returns the HTTP status code of the most recent request made
+        by the calling thread."""
+        return getattr(self._local, 'last_status', None)
+
+    def get_last_timings(self):
+        """Returns the timing breakdown of the most recent request made by
+        the calling thread, see Client.get_last_timings()."""
+        return getattr(self._local, 'last_timings', None)
+
+    def get_transfer_stats(self):
+        """Returns the sums of the Client.get_transfer_stats() counters of
+        all the shards."""
+        stats = {}
+        for shard in self.shards:
+            for name, value in shard.client.get_transfer_stats().items():
+                stats[name] = stats.get(name, 0) + value
+        return stats
+
+    def warm_up(self, n=None):
+        """See Client.warm_up(). Opens up to n connections to every shard,
+        all the shards in parallel.
+
+        Returns the list of the connection timings of all the shards.
+        Raises urllib3.exceptions.HTTPError
+        """
+        return [t for timings in self._map_shards(lambda s: s.client.warm_up(n)) for t in timings]
+
+    def get_coalesced_count(self):
+        """Returns the number of coalesced requests of all the shards."""
+        return sum(s.client.get_coalesced_count() for s in self.shards)
+
+    def priority(self, name):
+        """See Client.priority()."""
+        return priority_scope(name)
+
+    def get_scheduler_stats(self):
+        """Returns a dict of shard name -> Client.get_scheduler_stats()."""
+        return dict((s.name, s.client.get_scheduler_stats()) for s in self.shards)
+
+    def get_shard_stats(self):
+        """Returns a dict of shard name -> Shard.get_stats()."""
+        return dict((s.name, s.get_stats()) for s in self.shards)
@@ -0,0 +1,74 @@
+"""
+.. module:: clarify_cody.singleflight
+   : synopsis: 'Coalescing of duplicate in-flight requests'
+"""
+
+import threading
+
+
+class _Call(object):
+    """An in-flight call shared by every caller with the same key."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Makes sure only one execution of a function is in flight for a
+    given key at a time. Callers arriving while a call for their key is
+    still running wait for it and share its outcome: the returned value
+    or the raised exception (the same instance for every caller)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Execute func(*args, **kwargs), unless a call for 'key' is
+        already in flight, in which case wait for that call instead.
+        'key' must be hashable.
+
+        Returns the value returned by func.
+        Raises whatever func raised.
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if leader:
+            try:
+                call.result = func(*args, **kwargs)
+            except BaseException as exception:
+                call.exception = exception
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.exception is not None:
+            raise call.exception
+        return call.result
+
+    def in_flight(self):
+        """Returns the number of distinct calls currently in flight."""
+        with self._lock:
+            return len(self._calls)
+
+    def get_coalesced_count(self):
+        """Returns the number of calls that were served by another
+        caller's in-flight call instead of being executed."""
+        with self._lock:
+            return self._coalesced
@@ -35,8 +35,12 @@ setup(
         'urllib3',
         'certifi'
     ],
+    extras_require={
+        'compression': ['brotli', 'zstandard'],
+    },
     entry_points={
         'console_scripts': [
+            'clarify_cody_purge = clarify_cody.purge:main',
         ]
     },
     license="MIT",
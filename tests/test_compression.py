@@ -0,0 +1,72 @@
+import gzip
+import json
+import unittest
+import httpretty
+from clarify_cody.client import Client
+from clarify_cody.compression import get_decoder
+from clarify_cody.errors import APIDataException
+from . import load_body, host
+
+CONVERSATION_PATH = '/v1/conversations/a4736567-aa8e-4da8-beb0-9c61182b17fc'
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client('my-api-key', host, compress_requests=True, compress_min_size=100)
+
+    def tearDown(self):
+        self.client = None
+
+    def test_streaming_gzip_decoder(self):
+        data = gzip.compress(b'x' * 10000)
+        decoder = get_decoder('gzip')
+        out = b''.join(decoder.decompress(data[i:i + 7]) for i in range(0, len(data), 7)) + decoder.flush()
+        self.assertEqual(out, b'x' * 10000)
+        self.assertIsNone(get_decoder(None))
+        with self.assertRaises(ValueError):
+            get_decoder('compress')
+
+    @httpretty.activate
+    def test_gzip_response(self):
+        body = load_body('conversation.json').encode('utf-8')
+        httpretty.register_uri('GET', host + CONVERSATION_PATH, body=gzip.compress(body),
+                               adding_headers={'Content-Encoding': 'gzip'})
+
+        conv = self.client.get_conversation(CONVERSATION_PATH)
+
+        self.assertEqual(conv['external_id'], '123')
+        self.assertIn('gzip', httpretty.last_request().headers['Accept-Encoding'])
+        stats = self.client.get_transfer_stats()
+        self.assertEqual(stats['bytes_received_uncompressed'], len(body))
+        self.assertLess(stats['bytes_received'], len(body))
+
+    @httpretty.activate
+    def test_corrupt_response(self):
+        httpretty.register_uri('GET', host + CONVERSATION_PATH, body=b'not gzip',
+                               adding_headers={'Content-Encoding': 'gzip'})
+        with self.assertRaises(APIDataException):
+            self.client.get_conversation(CONVERSATION_PATH)
+
+    @httpretty.activate
+    def test_compressed_request_body(self):
+        httpretty.register_uri('POST', host + '/v1/conversations', body=load_body('conversation.json'),
+                               status=201, content_type='application/json')
+        participants = [{'name': 'p{}'.format(i), 'media': [{'url': 'https://example.com/{}.wav'.format(i)}]}
+                        for i in range(20)]
+
+        self.client.create_conversation(external_id='123', participants=participants)
+
+        request = httpretty.last_request()
+        self.assertEqual(request.headers['Content-Encoding'], 'gzip')
+        body = json.loads(gzip.decompress(request.body).decode('utf-8'))
+        self.assertEqual(body['participants'], participants)
+        stats = self.client.get_transfer_stats()
+        self.assertLess(stats['bytes_sent'], stats['bytes_sent_uncompressed'])
+
+    @httpretty.activate
+    def test_small_request_body_not_compressed(self):
+        httpretty.register_uri('POST', host + '/v1/conversations', body=load_body('conversation.json'),
+                               status=201, content_type='application/json')
+        self.client.create_conversation(external_id='123')
+        self.assertNotIn('Content-Encoding', httpretty.last_request().headers)
@@ -0,0 +1,51 @@
+import ssl
+import unittest
+import httpretty
+from clarify_cody.client import Client
+from clarify_cody.connection import ResumingSSLContext
+from . import load_body, host
+
+CONVERSATION_PATH = '/v1/conversations/a4736567-aa8e-4da8-beb0-9c61182b17fc'
+
+
+class TestConnection(unittest.TestCase):
+
+    def _register(self, base):
+        httpretty.register_uri('GET', base + CONVERSATION_PATH, body=load_body('conversation.json'),
+                               content_type='application/json')
+
+    def test_ssl_context_shared_by_clients(self):
+        context = Client('my-api-key', host).conn.conn_kw['ssl_context']
+        self.assertIsInstance(context, ResumingSSLContext)
+        self.assertIs(Client('other-key', host).conn.conn_kw['ssl_context'], context)
+
+    def test_certificates_are_not_reloaded(self):
+        pool = Client('my-api-key', host).conn
+        conn = pool._new_conn()
+        self.assertIsNone(conn.ca_certs)
+        self.assertEqual(conn.cert_reqs, ssl.CERT_REQUIRED)
+        self.assertTrue(pool.conn_kw['ssl_context'].check_hostname)
+
+    @httpretty.activate
+    def test_timings(self):
+        self._register(host)
+        client = Client('my-api-key', host)
+        self.assertIsNone(client.get_last_timings())
+
+        client.get_conversation(CONVERSATION_PATH)
+        timings = client.get_last_timings()
+        self.assertTrue(timings['new_connection'])
+        for phase in ('dns', 'connect', 'tls', 'first_byte', 'total'):
+            self.assertGreaterEqual(timings[phase], 0)
+        self.assertEqual(client.get_transfer_stats()['connections'], 1)
+
+    @httpretty.activate
+    def test_warm_up(self):
+        base = 'http://cdapi.clarify.io'
+        self._register(base)
+        client = Client('my-api-key', base, maxsize=2)
+
+        timings = client.warm_up(5)
+
+        self.assertEqual(len(timings), 2)
+        self.assertTrue(all(c.sock is not None for c in client.conn.pool.queue))
@@ -0,0 +1,106 @@
+import json
+import time
+import unittest
+import httpretty
+from clarify_cody.client import Client
+from clarify_cody.conversation_cache import ConversationCache
+from . import host
+
+CONVERSATION_PATH = '/v1/conversations/1'
+TRANSCRIPT_PATH = '/v1/conversations/1/insights/transcript'
+TRANSCRIPT = {'participants': [], '_links': {'self': {'href': TRANSCRIPT_PATH}}}
+
+
+def conversation_callback(request, uri, response_headers):
+    conv = {'external_id': '123',
+            '_links': {'self': {'href': CONVERSATION_PATH},
+                       'insight:transcript': {'href': TRANSCRIPT_PATH}}}
+    embedded = {}
+    for rel in request.querystring.get('embed', [''])[0].split('+'):
+        if rel == 'insight:transcript':
+            embedded[rel] = TRANSCRIPT
+        elif rel == 'insight:keywords':
+            embedded[rel] = {'keywords': []}
+    if embedded:
+        conv['_embedded'] = embedded
+    return [200, response_headers, json.dumps(conv)]
+
+
+class TestConversationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client('my-api-key', host, conversation_cache=ConversationCache())
+
+    def tearDown(self):
+        self.client = None
+
+    def _register(self):
+        httpretty.register_uri('GET', host + CONVERSATION_PATH, body=conversation_callback,
+                               content_type='application/json')
+        httpretty.register_uri('GET', host + TRANSCRIPT_PATH, body=json.dumps(TRANSCRIPT),
+                               content_type='application/json')
+
+    @httpretty.activate
+    def test_upgrade_fetches_only_missing_embed_link(self):
+        self._register()
+        conv = self.client.get_conversation(CONVERSATION_PATH)
+        self.assertNotIn('_embedded', conv)
+
+        conv = self.client.get_conversation(CONVERSATION_PATH, embed=['insight:transcript'])
+
+        paths = [r.path for r in httpretty.latest_requests()]
+        self.assertEqual(paths, [CONVERSATION_PATH, TRANSCRIPT_PATH])
+        direct = Client('my-api-key', host).get_conversation(CONVERSATION_PATH, embed=['insight:transcript'])
+        self.assertEqual(conv, direct)
+
+    @httpretty.activate
+    def test_held_embeds_are_not_refetched(self):
+        self._register()
+        self.client.get_conversation(CONVERSATION_PATH, embed='insight:transcript')
+        conv = self.client.get_conversation(CONVERSATION_PATH)
+        self.assertNotIn('_embedded', conv)
+        conv = self.client.get_conversation(CONVERSATION_PATH, embed=['insight:transcript'])
+        self.assertEqual(conv['_embedded']['insight:transcript'], TRANSCRIPT)
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+
+    @httpretty.activate
+    def test_unlinked_embed_is_fetched_through_conversation(self):
+        self._register()
+        self.client.get_conversation(CONVERSATION_PATH, embed=['insight:transcript'])
+        conv = self.client.get_conversation(CONVERSATION_PATH, embed=['insight:transcript', 'insight:keywords'])
+
+        self.assertEqual(sorted(conv['_embedded']), ['insight:keywords', 'insight:transcript'])
+        last = httpretty.last_request()
+        self.assertEqual(last.querystring['embed'], ['insight:keywords'])
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+
+    @httpretty.activate
+    def test_missing_embed_is_fetched_again(self):
+        self._register()
+        httpretty.register_uri('GET', host + TRANSCRIPT_PATH,
+                               responses=[httpretty.Response(body='{}', status=404),
+                                          httpretty.Response(body=json.dumps(TRANSCRIPT))],
+                               content_type='application/json')
+        self.client.get_conversation(CONVERSATION_PATH)
+        conv = self.client.get_conversation(CONVERSATION_PATH, embed=['insight:transcript'])
+        self.assertNotIn('_embedded', conv)
+
+        conv = self.client.get_conversation(CONVERSATION_PATH, embed=['insight:transcript'])
+        self.assertEqual(conv['_embedded']['insight:transcript'], TRANSCRIPT)
+        paths = [r.path for r in httpretty.latest_requests()]
+        self.assertEqual(paths, [CONVERSATION_PATH, TRANSCRIPT_PATH, TRANSCRIPT_PATH])
+
+    @httpretty.activate
+    def test_expiry_and_refresh(self):
+        self._register()
+        self.client.conversation_cache = ConversationCache(ttl=0.05)
+        self.client.get_conversation(CONVERSATION_PATH)
+        self.client.get_conversation(CONVERSATION_PATH)
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+
+        time.sleep(0.06)
+        self.client.get_conversation(CONVERSATION_PATH)
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+
+        self.client.get_conversation(CONVERSATION_PATH, refresh=True)
+        self.assertEqual(len(httpretty.latest_requests()), 3)
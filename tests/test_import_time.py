@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+# Budget for the cumulative time of 'import clarify_cody', in microseconds.
+# Importing the package eagerly (with urllib3) took about 100ms. Wall-clock
+# timings are unreliable on loaded machines, so the budget is only checked
+# when CLARIFY_CODY_BENCHMARK is set.
+IMPORT_TIME_BUDGET = 30000
+
+# Modules that must only be imported when a client needs them.
+LAZY_MODULES = ['urllib3', 'certifi', 'ssl', 'http.client', 'concurrent.futures', 'gzip', 'asyncio',
+                'brotli', 'zstandard', 'clarify_cody.client']
+
+
+def run_python(code):
+    """Run code in a fresh interpreter with -X importtime. Returns its stdout
+    and the import time report."""
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    return process.stdout, process.stderr
+
+
+def cumulative_import_time(report, module):
+    """Returns the cumulative import time of module, in microseconds, from
+    an -X importtime report."""
+    for line in report.splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1])
+    return None
+
+
+class TestImportTime(unittest.TestCase):
+
+    @unittest.skipUnless(os.environ.get('CLARIFY_CODY_BENCHMARK'), 'set CLARIFY_CODY_BENCHMARK to run')
+    def test_import_is_fast(self):
+        best = None
+        for _ in range(3):
+            _, report = run_python('import clarify_cody')
+            elapsed = cumulative_import_time(report, 'clarify_cody')
+            best = elapsed if best is None else min(best, elapsed)
+        self.assertLess(best, IMPORT_TIME_BUDGET, 'import clarify_cody took {} us'.format(best))
+
+    def test_heavy_modules_are_lazy(self):
+        code = ('import json, sys\n'
+                'before = set(sys.modules)\n'
+                'import clarify_cody, clarify_cody.helpers, clarify_cody.errors\n'
+                'print(json.dumps(sorted(set(sys.modules) - before)))\n')
+        stdout, _ = run_python(code)
+        loaded = json.loads(stdout)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, loaded)
+
+    def test_client_loads_transport_on_first_use(self):
+        code = ('import json, sys\n'
+                'from clarify_cody import Client\n'
+                'imported = "urllib3" in sys.modules\n'
+                'Client("key")\n'
+                'print(json.dumps([imported, "urllib3" in sys.modules]))\n')
+        stdout, _ = run_python(code)
+        self.assertEqual(json.loads(stdout), [False, True])
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import httpretty
+from clarify_cody.client import Client
+from clarify_cody.index import ExternalIdIndex
+from . import register_uris, host
+
+CONVERSATIONS_URI = host + '/v1/conversations'
+
+
+class TestExternalIdIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_add_result_conversation(self):
+        index = ExternalIdIndex()
+        index.add_result({'external_id': 'a', '_links': {'self': {'href': '/v1/conversations/1'}}})
+        self.assertEqual(index.get('a'), '/v1/conversations/1')
+
+    def test_add_result_single_item_collection(self):
+        index = ExternalIdIndex()
+        index.add_result({'_links': {'items': [{'href': '/v1/conversations/1'}]}}, 'a')
+        self.assertEqual(index.get('a'), '/v1/conversations/1')
+
+    def test_remove_href(self):
+        index = ExternalIdIndex({'a': '/v1/conversations/1', 'b': '/v1/conversations/2'})
+        index.remove_href('/v1/conversations/1')
+        self.assertNotIn('a', index)
+        self.assertEqual(len(index), 1)
+
+    def test_save_and_load(self):
+        path = os.path.join(self.tmpdir, 'index.json')
+        ExternalIdIndex({'a': '/v1/conversations/1'}).save(path)
+        self.assertEqual(ExternalIdIndex.load(path).get('a'), '/v1/conversations/1')
+        self.assertEqual(len(ExternalIdIndex.load(os.path.join(self.tmpdir, 'missing.json'))), 0)
+
+
+class TestResolveExternalIds(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client('my-api-key', host, maxsize=4)
+
+    def tearDown(self):
+        self.client = None
+
+    def _register_lookup(self):
+        def callback(request, uri, response_headers):
+            external_id = request.querystring['external_id'][0]
+            if external_id == 'missing':
+                return [404, response_headers, '{"status": 404, "message": "Not found"}']
+            body = {'_links': {'self': {'href': '/v1/conversations?external_id=' + external_id},
+                               'items': [{'href': '/v1/conversations/' + external_id}]}}
+            return [200, response_headers, json.dumps(body)]
+        httpretty.register_uri('GET', CONVERSATIONS_URI, body=callback, content_type='application/json')
+
+    @httpretty.activate
+    def test_create_conversation_fills_index(self):
+        register_uris(httpretty)
+        self.client.create_conversation(external_id='123')
+        self.assertEqual(self.client.external_id_index.get('123'),
+                         '/v1/conversations/a4736567-aa8e-4da8-beb0-9c61182b17fc')
+
+    @httpretty.activate
+    def test_resolve_fetches_only_misses(self):
+        self._register_lookup()
+        self.client.external_id_index.add('known', '/v1/conversations/known')
+
+        result = self.client.resolve_external_ids(['known', 'x', 'y', 'missing', 'x'])
+
+        self.assertEqual(result, {'known': '/v1/conversations/known',
+                                  'x': '/v1/conversations/x',
+                                  'y': '/v1/conversations/y',
+                                  'missing': None})
+        queried = sorted(r.querystring['external_id'][0] for r in httpretty.latest_requests())
+        self.assertEqual(queried, ['missing', 'x', 'y'])
+
+        httpretty.reset()
+        self._register_lookup()
+        result = self.client.resolve_external_ids(['known', 'x', 'y'])
+        self.assertEqual(result['y'], '/v1/conversations/y')
+        self.assertEqual(len(httpretty.latest_requests()), 0)
+
+    def test_concurrency_beyond_maxsize(self):
+        with self.assertRaises(AssertionError):
+            self.client.resolve_external_ids(['x'], concurrency=8)
@@ -0,0 +1,210 @@
+import datetime
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout, redirect_stderr
+from unittest import mock
+import httpretty
+from clarify_cody.client import Client
+from clarify_cody.purge import PurgeLog, main, older_than
+from . import host
+
+LIST_URI = host + '/v1/conversations'
+NOW = datetime.datetime(2026, 10, 1, tzinfo=datetime.timezone.utc)
+CREATED = {'1': '2026-01-01T00:00:00Z', '2': '2026-09-30', '3': '2025-12-31T12:00:00',
+           '4': '2026-02-01T00:00:00+00:00'}
+
+
+def href(conversation_id):
+    return '/v1/conversations/' + conversation_id
+
+
+class TestPurge(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client('my-api-key', host, maxsize=4)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.client = None
+        shutil.rmtree(self.tmpdir)
+
+    def _register(self, delete_status=None):
+        def list_callback(request, uri, response_headers):
+            if request.querystring.get('offset') == ['2']:
+                links = {'items': [{'href': href('3')}, {'href': href('4')}]}
+            else:
+                links = {'items': [{'href': href('1')}, {'href': href('2')}],
+                         'next': {'href': '/v1/conversations?offset=2'}}
+            return [200, response_headers, json.dumps({'_links': links})]
+        httpretty.register_uri('GET', LIST_URI, body=list_callback, content_type='application/json')
+
+        for conversation_id, created in CREATED.items():
+            body = json.dumps({'created': created, '_links': {'self': {'href': href(conversation_id)}}})
+            httpretty.register_uri('GET', host + href(conversation_id), body=body,
+                                   content_type='application/json')
+            status = (delete_status or {}).get(conversation_id, 204)
+            httpretty.register_uri('DELETE', host + href(conversation_id), body='', status=status)
+
+    def _requests(self, method):
+        return sorted(r.path for r in httpretty.latest_requests() if r.method == method)
+
+    @httpretty.activate
+    def test_purge_older_than(self):
+        self._register()
+        report = self.client.purge(older_than(30, now=NOW), concurrency=3)
+
+        self.assertEqual(report.scanned, 4)
+        self.assertEqual(sorted(report.deleted), [href('1'), href('3'), href('4')])
+        self.assertEqual(report.failed, [])
+        self.assertEqual(self._requests('DELETE'), [href('1'), href('3'), href('4')])
+
+    @httpretty.activate
+    def test_dry_run(self):
+        self._register()
+        report = self.client.purge(older_than(30, now=NOW), dry_run=True)
+
+        self.assertEqual(sorted(report.matched), [href('1'), href('3'), href('4')])
+        self.assertEqual(report.deleted, [])
+        self.assertEqual(self._requests('DELETE'), [])
+
+    @httpretty.activate
+    def test_href_predicate_fetches_nothing(self):
+        self._register()
+        report = self.client.purge(lambda conversation: conversation.href == href('2'))
+
+        self.assertEqual(report.deleted, [href('2')])
+        # The first page is listed again after the delete.
+        self.assertEqual(self._requests('GET'),
+                         ['/v1/conversations', '/v1/conversations', '/v1/conversations?offset=2'])
+
+    @httpretty.activate
+    def test_failures_are_reported_apart(self):
+        self._register(delete_status={'3': 403, '4': 404})
+        log_path = os.path.join(self.tmpdir, 'purge.log')
+        report = self.client.purge(older_than(30, now=NOW), log_path=log_path)
+
+        self.assertEqual(sorted(report.deleted), [href('1'), href('4')])
+        self.assertEqual([(h, e.get_http_response()) for h, e in report.failed], [(href('3'), 403)])
+        log = PurgeLog(log_path)
+        log.close()
+        self.assertEqual(log.deleted, set([href('1'), href('4')]))
+        self.assertTrue(log.finished)
+
+    @httpretty.activate
+    def test_resume_from_log(self):
+        self._register()
+        log_path = os.path.join(self.tmpdir, 'purge.log')
+        with open(log_path, 'w') as f:
+            f.write(json.dumps({'deleted': href('1')}) + '\n')
+            f.write(json.dumps({'page': '/v1/conversations?offset=2'}) + '\n')
+            f.write('{"deleted": "/v1/conv')
+
+        report = self.client.purge(older_than(30, now=NOW), log_path=log_path)
+
+        self.assertEqual(report.scanned, 2)
+        self.assertEqual(sorted(report.deleted), [href('3'), href('4')])
+        log = PurgeLog(log_path)
+        log.close()
+        self.assertEqual(log.deleted, set([href('1'), href('3'), href('4')]))
+        self.assertTrue(log.finished)
+        with open(log_path) as f:
+            self.assertTrue(all(json.loads(line) for line in f))
+        self.assertNotIn('/v1/conversations', self._requests('GET'))
+        self.assertIn('/v1/conversations?offset=2', self._requests('GET'))
+
+    def _register_offset_server(self, count, page_size):
+        conversation_ids = [str(i) for i in range(count)]
+
+        def list_callback(request, uri, response_headers):
+            offset = int(request.querystring.get('offset', ['0'])[0])
+            page = conversation_ids[offset:offset + page_size]
+            links = {'items': [{'href': href(i)} for i in page]}
+            if offset + page_size < len(conversation_ids):
+                links['next'] = {'href': '/v1/conversations?offset={}'.format(offset + page_size)}
+            return [200, response_headers, json.dumps({'_links': links})]
+
+        def delete_callback(request, uri, response_headers):
+            conversation_ids.remove(request.path.rsplit('/', 1)[1])
+            return [204, response_headers, '']
+
+        httpretty.register_uri('GET', LIST_URI, body=list_callback, content_type='application/json')
+        httpretty.register_uri('DELETE', re.compile(host + r'/v1/conversations/\d+$'), body=delete_callback)
+        return conversation_ids
+
+    @httpretty.activate
+    def test_shifting_pages(self):
+        conversation_ids = self._register_offset_server(40, 10)
+        report = self.client.purge(lambda conversation: True, concurrency=4)
+
+        self.assertEqual(conversation_ids, [])
+        self.assertEqual((report.scanned, len(report.deleted)), (40, 40))
+
+    @httpretty.activate
+    def test_shifting_pages_partial_match(self):
+        conversation_ids = self._register_offset_server(40, 10)
+        checked = []
+
+        def predicate(conversation):
+            checked.append(conversation.href)
+            return int(conversation.href.rsplit('/', 1)[1]) % 3 != 0
+
+        report = self.client.purge(predicate, concurrency=4)
+
+        self.assertEqual(conversation_ids, [str(i) for i in range(0, 40, 3)])
+        self.assertEqual(len(report.deleted), 26)
+        self.assertEqual(sorted(checked), sorted(href(str(i)) for i in range(40)))
+
+    @httpretty.activate
+    def test_deletes_run_concurrently(self):
+        self._register()
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def delete_callback(request, uri, response_headers):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+            return [204, response_headers, '']
+
+        for conversation_id in CREATED:
+            httpretty.register_uri('DELETE', host + href(conversation_id), body=delete_callback)
+        report = self.client.purge(lambda conversation: True)
+
+        self.assertEqual(len(report.deleted), 4)
+        self.assertGreater(in_flight[1], 1)
+
+    def test_concurrency_beyond_maxsize(self):
+        with self.assertRaises(AssertionError):
+            Client('my-api-key', host).purge(lambda conversation: True, concurrency=8)
+
+    @httpretty.activate
+    def test_cli_dry_run(self):
+        self._register()
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with mock.patch.dict(os.environ, {'CODY_API_KEY': 'my-api-key'}), \
+                redirect_stdout(stdout), redirect_stderr(stderr):
+            status = main(['--older-than', '0', '--dry-run', '--url', host])
+
+        self.assertEqual(status, 0)
+        self.assertEqual(len(stdout.getvalue().split()), 4)
+        self.assertIn('DRY RUN', stderr.getvalue())
+        self.assertEqual(self._requests('DELETE'), [])
+
+    def test_cli_without_key(self):
+        environ = dict((k, v) for k, v in os.environ.items() if k != 'CODY_API_KEY')
+        stderr = io.StringIO()
+        with mock.patch.dict(os.environ, environ, clear=True), redirect_stderr(stderr):
+            with self.assertRaises(SystemExit) as context:
+                main(['--older-than', '30'])
+        self.assertEqual(context.exception.code, 2)
+        self.assertIn('CODY_API_KEY', stderr.getvalue())
@@ -0,0 +1,78 @@
+import json
+import unittest
+import httpretty
+from clarify_cody.client import Client
+from clarify_cody.helpers import get_link_href
+from clarify_cody.resource import Resource
+from . import host
+
+CONVERSATION_PATH = '/v1/conversations/1'
+TRANSCRIPT_PATH = '/v1/conversations/1/insights/transcript'
+
+
+def conversation(embed_transcript=False):
+    conv = {'external_id': '123',
+            '_links': {'self': {'href': CONVERSATION_PATH},
+                       'insight:transcript': {'href': TRANSCRIPT_PATH}}}
+    if embed_transcript:
+        conv['_embedded'] = {'insight:transcript': {'participants': [],
+                                                    '_links': {'self': {'href': TRANSCRIPT_PATH}}}}
+    return conv
+
+
+class TestResource(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client('my-api-key', host)
+
+    def tearDown(self):
+        self.client = None
+
+    def test_raw_json_is_decoded_on_access(self):
+        resource = Resource(raw=json.dumps(conversation()))
+        self.assertFalse(resource.loaded)
+        self.assertEqual(resource['external_id'], '123')
+        self.assertTrue(resource.loaded)
+        self.assertEqual(resource.href, CONVERSATION_PATH)
+        self.assertEqual(get_link_href(resource, 'insight:transcript'), TRANSCRIPT_PATH)
+
+    @httpretty.activate
+    def test_identity_map_fetches_once(self):
+        httpretty.register_uri('GET', host + CONVERSATION_PATH, body=json.dumps(conversation()),
+                               content_type='application/json')
+        httpretty.register_uri('GET', host + TRANSCRIPT_PATH, body='{"participants": []}',
+                               content_type='application/json')
+
+        resource = self.client.get_resource(CONVERSATION_PATH)
+        self.assertEqual(len(httpretty.latest_requests()), 0)
+        self.assertIs(self.client.get_resource(CONVERSATION_PATH), resource)
+
+        transcript = resource.follow('insight:transcript')
+        self.assertEqual(transcript['participants'], [])
+        self.assertIs(resource.follow('insight:transcript'), transcript)
+        self.assertEqual(transcript['participants'], [])
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+
+    @httpretty.activate
+    def test_follow_uses_embedded(self):
+        httpretty.register_uri('GET', host + TRANSCRIPT_PATH, body='{"participants": []}',
+                               content_type='application/json')
+
+        resource = Resource(self.client, data=conversation(embed_transcript=True))
+        transcript = resource.follow('insight:transcript')
+        self.assertEqual(transcript['participants'], [])
+        self.assertIs(self.client.get_resource(TRANSCRIPT_PATH), transcript)
+        self.assertEqual(len(httpretty.latest_requests()), 0)
+
+    @httpretty.activate
+    def test_delete_forgets_resource(self):
+        httpretty.register_uri('GET', host + CONVERSATION_PATH, body=json.dumps(conversation()),
+                               content_type='application/json')
+        httpretty.register_uri('DELETE', host + CONVERSATION_PATH, body='', status=204)
+
+        resource = self.client.get_resource(CONVERSATION_PATH)
+        self.assertEqual(resource['external_id'], '123')
+        self.client.delete_conversation(CONVERSATION_PATH)
+
+        self.assertIsNot(self.client.get_resource(CONVERSATION_PATH), resource)
+        self.assertFalse(self.client.get_resource(CONVERSATION_PATH).loaded)
@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+import unittest
+import httpretty
+from clarify_cody.client import Client
+from clarify_cody.scheduler import RequestScheduler, BATCH, INTERACTIVE, get_priority, priority
+from . import host
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def _wait_queued(self, scheduler, count):
+        while sum(s['queued'] for s in scheduler.get_stats().values()) < count:
+            time.sleep(0.001)
+
+    def test_interactive_overtakes_batch(self):
+        scheduler = RequestScheduler(slots=1)
+        order = []
+
+        def run(name, label):
+            with scheduler.slot(name):
+                order.append(label)
+
+        scheduler.acquire(BATCH)
+        threads = []
+        for i, (name, label) in enumerate([(BATCH, 'b1'), (BATCH, 'b2'),
+                                           (INTERACTIVE, 'i1'), (INTERACTIVE, 'i2')]):
+            t = threading.Thread(target=run, args=(name, label))
+            t.start()
+            threads.append(t)
+            self._wait_queued(scheduler, i + 1)
+        scheduler.release(BATCH)
+        for t in threads:
+            t.join()
+
+        self.assertEqual(order, ['i1', 'i2', 'b1', 'b2'])
+        stats = scheduler.get_stats()
+        self.assertEqual(stats[BATCH]['dispatched'], 3)
+        self.assertEqual(stats[INTERACTIVE]['queued'], 0)
+        self.assertGreater(stats[BATCH]['max_wait'], 0)
+
+    def test_priority_scope(self):
+        self.assertIsNone(get_priority())
+        with priority(BATCH):
+            self.assertEqual(get_priority(), BATCH)
+        self.assertIsNone(get_priority())
+
+
+class TestClientPriority(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client('my-api-key', host)
+
+    def tearDown(self):
+        self.client = None
+
+    @httpretty.activate
+    def test_list_map_is_batch(self):
+        page = {'_links': {'self': {'href': '/v1/conversations'},
+                           'items': [{'href': '/v1/conversations/1'}]}}
+        httpretty.register_uri('GET', host + '/v1/conversations', body=json.dumps(page),
+                               content_type='application/json')
+        httpretty.register_uri('GET', host + '/v1/conversations/1', body='{"_links": {}}',
+                               content_type='application/json')
+
+        self.client.conversation_list_map(lambda client, href: client.get_conversation(href))
+        with self.client.priority(INTERACTIVE):
+            self.client.get_conversation('/v1/conversations/1')
+
+        stats = self.client.get_scheduler_stats()
+        self.assertEqual(stats[BATCH]['dispatched'], 2)
+        self.assertEqual(stats[INTERACTIVE]['dispatched'], 1)
+
+    @httpretty.activate
+    def test_default_client_is_not_serialized(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def callback(request, uri, response_headers):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+            return [200, response_headers, '{"_links": {}}']
+
+        httpretty.register_uri('GET', host + '/v1/conversations/1', body=callback,
+                               content_type='application/json')
+        threads = [threading.Thread(target=self.client.get, args=('/v1/conversations/1',)) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertGreater(in_flight[1], 1)
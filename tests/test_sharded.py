@@ -0,0 +1,193 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import httpretty
+from clarify_cody.errors import APIRequestException
+from clarify_cody.index import ExternalIdIndex
+from clarify_cody.ratelimit import TokenBucket
+from clarify_cody.sharded import ShardedClient, ShardOwnerIndex
+from . import load_body
+
+HOSTS = ['https://cdapi-a.clarify.io', 'https://cdapi-b.clarify.io', 'https://cdapi-c.clarify.io']
+CONVERSATION_PATH = '/v1/conversations/a4736567-aa8e-4da8-beb0-9c61182b17fc'
+
+
+class TestShardedClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ShardedClient([('key-a', HOSTS[0]), ('key-b', HOSTS[1]), ('key-c', HOSTS[2])],
+                                    max_failures=1)
+
+    def tearDown(self):
+        self.client = None
+
+    def _register(self, status=200):
+        for host in HOSTS:
+            httpretty.register_uri('POST', host + '/v1/conversations', body=load_body('conversation.json'),
+                                   status=201, content_type='application/json')
+            httpretty.register_uri('GET', host + CONVERSATION_PATH, body=load_body('conversation.json'),
+                                   status=status, content_type='application/json')
+
+    def test_routing_is_stable_and_balanced(self):
+        counts = {}
+        for i in range(3000):
+            shard = self.client.get_shard('/v1/conversations/{}'.format(i))
+            self.assertIs(shard, self.client.get_shard('/v1/conversations/{}'.format(i)))
+            counts[shard.name] = counts.get(shard.name, 0) + 1
+        self.assertEqual(len(counts), 3)
+        self.assertTrue(all(c > 600 for c in counts.values()))
+
+    @httpretty.activate
+    def test_conversation_stays_with_external_id_shard(self):
+        self._register()
+        self.client.create_conversation(external_id='123')
+        owner = self.client.get_shard('123')
+        self.client.get_conversation(CONVERSATION_PATH)
+
+        hosts = [r.headers['Host'] for r in httpretty.latest_requests()]
+        self.assertEqual(len(set(hosts)), 1)
+        self.assertEqual(owner.get_stats()['requests'], 2)
+
+    def _fetch_host(self, client):
+        httpretty.reset()
+        self._register()
+        client.get_conversation(CONVERSATION_PATH)
+        return httpretty.last_request().headers['Host']
+
+    @httpretty.activate
+    def test_owner_survives_new_client(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self._register()
+        self.client.create_conversation(external_id='123')
+        created_host = httpretty.last_request().headers['Host']
+        self.client.owner_index.save(os.path.join(tmpdir, 'owners.json'))
+        self.client.external_id_index.save(os.path.join(tmpdir, 'index.json'))
+        shards = [('key-a', HOSTS[0]), ('key-b', HOSTS[1]), ('key-c', HOSTS[2])]
+
+        fresh = ShardedClient(shards, owner_index=ShardOwnerIndex.load(os.path.join(tmpdir, 'owners.json')))
+        self.assertEqual(self._fetch_host(fresh), created_host)
+        # The external_id_index alone is enough for conversations with an
+        # external_id.
+        fresh = ShardedClient(shards,
+                              external_id_index=ExternalIdIndex.load(os.path.join(tmpdir, 'index.json')))
+        self.assertEqual(self._fetch_host(fresh), created_host)
+
+    @httpretty.activate
+    def test_owner_of_conversation_without_external_id(self):
+        self._register()
+        hashed = self.client.get_shard(CONVERSATION_PATH)
+        hashed._record(False)
+        self.client.create_conversation()
+        owner = self.client.get_shard(CONVERSATION_PATH)
+        self.assertIsNot(owner, hashed)
+
+        hashed._down_until = 0.0
+        self.assertIs(self.client.get_shard(CONVERSATION_PATH), owner)
+
+    @httpretty.activate
+    def test_external_id_follows_owner(self):
+        self._register()
+        for host in HOSTS:
+            httpretty.register_uri('GET', host + '/v1/conversations', body=load_body('conversation.json'),
+                                   content_type='application/json')
+        hashed = self.client.get_shard('123')
+        hashed._record(False)
+        self.client.create_conversation(external_id='123')
+        owner = self.client.get_shard(CONVERSATION_PATH)
+        self.assertIsNot(owner, hashed)
+
+        hashed._down_until = 0.0
+        self.client.get_conversation_for_external_id('123')
+        self.assertEqual(httpretty.last_request().headers['Host'], owner.client.conn.host)
+        self.assertIs(self.client.get_shard('123'), owner)
+        self.assertIs(self.client.get_shard(CONVERSATION_PATH), owner)
+
+    @httpretty.activate
+    def test_list_map_walks_every_shard(self):
+        client = ShardedClient([('key-a', HOSTS[0]), ('key-b', HOSTS[1])])
+        for i, host in enumerate(HOSTS[:2]):
+            hrefs = ['/v1/conversations/{}-{}'.format(i, j) for j in range(10)]
+            pages = [{'_links': {'items': [{'href': h} for h in hrefs[:5]],
+                                 'next': {'href': '/v1/conversations?offset=5'}}},
+                     {'_links': {'items': [{'href': h} for h in hrefs[5:]]}}]
+            httpretty.register_uri('GET', host + '/v1/conversations',
+                                   responses=[httpretty.Response(json.dumps(page)) for page in pages],
+                                   content_type='application/json')
+            for h in hrefs:
+                httpretty.register_uri('GET', host + h, body='{}', content_type='application/json')
+
+        fetched = []
+
+        def func(sharded_client, href):
+            sharded_client.get_conversation(href)
+            fetched.append((href, httpretty.last_request().headers['Host']))
+
+        self.assertEqual(client.conversation_list_map(func), 20)
+        for href, fetch_host in fetched:
+            self.assertEqual(fetch_host, HOSTS[int(href.rsplit('/', 1)[1][0])][8:])
+
+    @httpretty.activate
+    def test_client_methods(self):
+        self._register()
+        httpretty.register_uri('DELETE', HOSTS[0] + CONVERSATION_PATH, body='', status=204)
+        result = self.client.get(CONVERSATION_PATH)
+        self.assertEqual(result.status, 200)
+        self.assertEqual(httpretty.last_request().headers['Host'],
+                         self.client.get_shard(CONVERSATION_PATH).client.conn.host)
+        self.assertIsNotNone(self.client.get_last_timings())
+        self.client.post('/v1/conversations', {'external_id': '123'})
+
+        stats = self.client.get_transfer_stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['bytes_received'], 2 * len(load_body('conversation.json').encode('utf-8')))
+
+    @httpretty.activate
+    def test_warm_up_and_purge_every_shard(self):
+        client = ShardedClient([('key-a', HOSTS[0].replace('https', 'http')),
+                                ('key-b', HOSTS[1].replace('https', 'http'))], maxsize=2)
+        for i, host in enumerate(HOSTS[:2]):
+            host = host.replace('https', 'http')
+            items = [{'href': '/v1/conversations/{}-{}'.format(i, j)} for j in range(2)]
+            httpretty.register_uri('GET', host + '/v1/conversations', body=json.dumps({'_links': {'items': items}}),
+                                   content_type='application/json')
+            httpretty.register_uri('DELETE', host + '/v1/conversations/{}-0'.format(i), body='', status=204)
+
+        self.assertEqual(len(client.warm_up()), 4)
+        report = client.purge(lambda conversation: conversation.href.endswith('-0'), concurrency=2)
+
+        self.assertEqual(report.scanned, 4)
+        self.assertEqual(sorted(report.deleted), ['/v1/conversations/0-0', '/v1/conversations/1-0'])
+
+    @httpretty.activate
+    def test_unhealthy_shard_is_skipped(self):
+        self._register(status=503)
+        owner = self.client.get_shard(CONVERSATION_PATH)
+        with self.assertRaises(APIRequestException):
+            self.client.get_conversation(CONVERSATION_PATH)
+        self.assertEqual(self.client.get_last_status(), 503)
+
+        self.assertFalse(owner.is_healthy())
+        self.assertIsNot(self.client.get_shard(CONVERSATION_PATH), owner)
+        self.assertFalse(self.client.get_shard_stats()[owner.name]['healthy'])
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_rate(self):
+        bucket = TokenBucket(100, burst=1)
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        start = time.monotonic()
+        for _ in range(5):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def test_pause(self):
+        bucket = TokenBucket(1000)
+        bucket.pause(0.05)
+        self.assertFalse(bucket.try_acquire())
+        self.assertGreaterEqual(bucket.acquire(), 0.04)
@@ -0,0 +1,165 @@
+import asyncio
+import threading
+import time
+import unittest
+import httpretty
+from clarify_cody.aio import AsyncClient
+from clarify_cody.client import Client
+from clarify_cody.errors import APIRequestException
+from clarify_cody.scheduler import BATCH, INTERACTIVE, priority
+from clarify_cody.singleflight import SingleFlight
+from . import load_body, host
+
+CONVERSATION_PATH = '/v1/conversations/a4736567-aa8e-4da8-beb0-9c61182b17fc'
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_share_result(self):
+        group = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def work():
+            calls.append(1)
+            release.wait()
+            return 'result'
+
+        threads = [threading.Thread(target=lambda: results.append(group.do('k', work))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        while group.get_coalesced_count() < 4:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(group.in_flight(), 0)
+
+    def test_exception_is_shared(self):
+        group = SingleFlight()
+        release = threading.Event()
+        errors = []
+
+        def work():
+            release.wait()
+            raise ValueError('boom')
+
+        def run():
+            try:
+                group.do('k', work)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for t in threads:
+            t.start()
+        while group.get_coalesced_count() < 2:
+            time.sleep(0.001)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(e is errors[0] for e in errors))
+
+    def test_sequential_calls_are_not_coalesced(self):
+        group = SingleFlight()
+        self.assertEqual(group.do('k', lambda: 1), 1)
+        self.assertEqual(group.do('k', lambda: 2), 2)
+        self.assertEqual(group.get_coalesced_count(), 0)
+
+
+class TestClientCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        self.client = Client('my-api-key', host)
+
+    def tearDown(self):
+        self.client = None
+
+    def _register_slow_conversation(self, status=200):
+        def callback(request, uri, response_headers):
+            time.sleep(0.2)
+            return [status, response_headers, load_body('conversation.json')]
+        httpretty.register_uri('GET', host + CONVERSATION_PATH, body=callback,
+                               content_type='application/json')
+
+    @httpretty.activate
+    def test_get_conversation_coalesced(self):
+        self._register_slow_conversation()
+        results = []
+
+        def fetch(embed):
+            results.append(self.client.get_conversation(CONVERSATION_PATH, embed=embed))
+
+        threads = [threading.Thread(target=fetch, args=(['a', 'b'],)),
+                   threading.Thread(target=fetch, args=('b+a',)),
+                   threading.Thread(target=fetch, args=(['b', 'a'],))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+        self.assertEqual(self.client.get_coalesced_count(), 2)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], results[1])
+        self.assertIsNot(results[0], results[1])
+
+    @httpretty.activate
+    def test_priority_classes_are_not_coalesced(self):
+        self._register_slow_conversation()
+        self.client = Client('my-api-key', host, maxsize=2)
+
+        def fetch(name):
+            with priority(name):
+                self.client.get_conversation(CONVERSATION_PATH)
+
+        threads = [threading.Thread(target=fetch, args=(name,)) for name in (BATCH, INTERACTIVE, INTERACTIVE)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(httpretty.latest_requests()), 2)
+        self.assertEqual(self.client.get_coalesced_count(), 1)
+
+    @httpretty.activate
+    def test_get_conversation_coalesced_error(self):
+        self._register_slow_conversation(status=404)
+        errors = []
+
+        def fetch():
+            try:
+                self.client.get_conversation(CONVERSATION_PATH)
+            except APIRequestException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    @httpretty.activate
+    def test_async_get_conversation_coalesced(self):
+        self._register_slow_conversation()
+        aclient = AsyncClient(None, client=self.client)
+
+        async def fetch_all():
+            return await asyncio.gather(*[aclient.get_conversation(CONVERSATION_PATH) for _ in range(4)])
+
+        results = asyncio.new_event_loop().run_until_complete(fetch_all())
+
+        self.assertEqual(len(httpretty.latest_requests()), 1)
+        self.assertEqual(aclient.get_coalesced_count(), 3)
+        self.assertEqual(results[0]['external_id'], '123')
+        self.assertEqual(results[0], results[3])